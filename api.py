@@ -0,0 +1,221 @@
+from functools import wraps
+
+from flask import Blueprint, g, jsonify, request, session
+
+from helpers import get_identity, load_order
+from listing import parse_filters, list_orders
+from orders import apply_action, apply_actions, create_order, order_history, set_price
+from validation import validate_order
+
+# Version 1 of the JSON API, a later incompatible version gets its own blueprint next to this one
+api = Blueprint("api", __name__, url_prefix="/api/v1")
+
+# Fields of an order in the listing, and the ones the detail adds
+LIST_FIELDS = ("order_id", "version", "order_name", "price", "price_display", "status", "status_label",
+               "order_due_date", "created_at")
+DETAIL_FIELDS = LIST_FIELDS + ("updated_at", "character_part", "preferred_style", "pose_view", "pose_description",
+                               "character_features_description", "outfit_description", "has_background",
+                               "background_description", "user", "colors", "character_references",
+                               "background_references", "reference_status")
+
+# Most actions one batch may apply
+MAX_BATCH_SIZE = 500
+
+# Text fields of a new order, as in the order form
+ORDER_FIELDS = ("order_name", "character_part", "preferred_style", "pose_view", "pose_description",
+                "character_features_description", "outfit_description", "background", "background_description",
+                "due_date")
+
+
+def api_error(message, code=400, **details):
+    """ Returns a JSON error, with any details (such as every problem found) next to its message """
+    return jsonify(error=message, **details), code
+
+
+def api_login_required(f):
+    """ Like login_required, but answers 401 instead of redirecting to the login page """
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if session.get("user_id") is None or get_identity(session["user_id"]) is None:
+            return api_error("login required", 401)
+        return f(*args, **kwargs)
+
+    return decorated_function
+
+
+def requested_fields(available):
+    """ Returns the fields asked for with ?fields=a,b (all of them by default), or None if one does not exist """
+    if not request.args.get("fields"):
+        return available
+    fields = [field.strip() for field in request.args["fields"].split(",") if field.strip()]
+    if not fields or any(field not in available for field in fields):
+        return None
+    return fields
+
+
+def action_error(error):
+    """ Turns an error of apply_action() into a JSON error """
+    if isinstance(error, LookupError):
+        return api_error(str(error), 404)
+    if isinstance(error, PermissionError):
+        return api_error(str(error), 403)
+    return api_error(str(error), 409)
+
+
+@api.route("/orders")
+@api_login_required
+def orders():
+    """ One page of orders, filtered like the index page """
+    is_admin = g.identity["is_admin"]
+
+    fields = requested_fields(LIST_FIELDS)
+    if fields is None:
+        return api_error(f"fields must be some of {', '.join(LIST_FIELDS)}")
+
+    filters = parse_filters(request.args, is_admin)
+    if not filters:
+        return api_error("invalid filter")
+
+    # Users can only see their own orders
+    if not is_admin:
+        filters["user_id"] = g.identity["id"]
+
+    page, next_cursor = list_orders(**filters)
+
+    return jsonify(orders=[{field: order[field] for field in fields} for order in page], next=next_cursor)
+
+
+@api.route("/orders/<int:order_id>")
+@api_login_required
+def order(order_id):
+    """ One order with its owner, palette and references """
+    is_admin = g.identity["is_admin"]
+
+    fields = requested_fields(DETAIL_FIELDS)
+    if fields is None:
+        return api_error(f"fields must be some of {', '.join(DETAIL_FIELDS)}")
+
+    # Users can only see their own orders
+    details = load_order(order_id, None if is_admin else g.identity["id"])
+    if not details:
+        return api_error(f"no such order: {order_id}", 404)
+
+    record = {
+        **details["order"],
+        "user": details["user_info"],
+        "colors": [color["color_hex"] for color in details["colors"]],
+        "character_references": [reference["file_path"] for reference in details["character_references"]],
+        "background_references": [reference["file_path"] for reference in details["background_references"]],
+        # pending while the file is being stored, ready once it is, failed if it could not be
+        "reference_status": {reference["file_path"]: reference["status"]
+                             for reference in details["character_references"] + details["background_references"]},
+    }
+    return jsonify({field: record[field] for field in fields})
+
+
+@api.route("/orders", methods=["POST"])
+@api_login_required
+def place_order():
+    """ Places an order from the JSON fields of the order form, without references """
+    if g.identity["is_admin"]:
+        return api_error("admins cannot place orders", 403)
+
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return api_error("expected a JSON object")
+
+    colors = data.get("colors", [])
+    if not isinstance(colors, list) or not all(isinstance(color, str) for color in colors):
+        return api_error("colors must be a list of strings")
+    if not all(isinstance(data.get(field, ""), (str, type(None))) for field in ORDER_FIELDS):
+        return api_error("order fields must be strings")
+
+    form_data, errors = validate_order(data, colors)
+    if errors:
+        return api_error(errors[0], errors=errors)
+
+    order_id = create_order(g.identity["id"], form_data, {}, {})
+    return jsonify(order_id=order_id), 201
+
+
+@api.route("/orders/<int:order_id>/actions", methods=["POST"])
+@api_login_required
+def order_action(order_id):
+    """ Accepts, rejects, completes or removes an order """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not isinstance(data.get("action"), str):
+        return api_error("expected {\"action\": ...}")
+
+    try:
+        status = apply_action(order_id, data["action"], g.identity["id"], g.identity["is_admin"])
+    except (LookupError, PermissionError, ValueError) as error:
+        return action_error(error)
+
+    return jsonify(order_id=order_id, status=status, deleted=status is None)
+
+
+@api.route("/orders/batch", methods=["POST"])
+@api_login_required
+def batch():
+    """
+    Applies many actions in one transaction, all of them or none.
+
+    Expects {"actions": [{"order_id": 1, "action": "accept"}, ...]}.
+    """
+    data = request.get_json(silent=True)
+    actions = data.get("actions") if isinstance(data, dict) else None
+    if not isinstance(actions, list) or not actions:
+        return api_error("expected {\"actions\": [...]}")
+    if len(actions) > MAX_BATCH_SIZE:
+        return api_error(f"at most {MAX_BATCH_SIZE} actions per batch")
+
+    pairs = []
+    for item in actions:
+        # JSON true and false are bools, which Python counts as the integers 1 and 0
+        if (not isinstance(item, dict) or not isinstance(item.get("order_id"), int)
+                or isinstance(item.get("order_id"), bool) or not isinstance(item.get("action"), str)):
+            return api_error("every action needs an integer order_id and an action")
+        pairs.append((item["order_id"], item["action"]))
+
+    try:
+        statuses = apply_actions(pairs, g.identity["id"], g.identity["is_admin"])
+    except (LookupError, PermissionError, ValueError) as error:
+        return action_error(error)
+
+    return jsonify(results=[{"order_id": order_id, "action": action, "status": status, "deleted": status is None}
+                            for (order_id, action), status in zip(pairs, statuses)])
+
+
+@api.route("/orders/<int:order_id>/events")
+@api_login_required
+def events(order_id):
+    """ The log of an order's status changes, oldest first """
+    is_admin = g.identity["is_admin"]
+
+    # Users can only see their own orders, the events of deleted orders are only shown to admins
+    if not is_admin and not load_order(order_id, g.identity["id"]):
+        return api_error(f"no such order: {order_id}", 404)
+
+    return jsonify(events=[{key: event[key] for key in ("ts", "event", "from_status", "to_status", "username", "price")}
+                           for event in order_history(order_id)])
+
+
+@api.route("/orders/<int:order_id>/price", methods=["PUT"])
+@api_login_required
+def price(order_id):
+    """ Sets the price of an order, which marks it reviewed """
+    if not g.identity["is_admin"]:
+        return api_error("only admins can set prices", 403)
+
+    data = request.get_json(silent=True)
+    value = data.get("price") if isinstance(data, dict) else None
+    if not isinstance(value, (int, float)) or isinstance(value, bool) or value < 0:
+        return api_error("price must be a positive number")
+
+    try:
+        status = set_price(order_id, value, g.identity["id"])
+    except (LookupError, PermissionError, ValueError) as error:
+        return action_error(error)
+
+    return jsonify(order_id=order_id, price=value, status=status)
@@ -1,85 +1,291 @@
 import os
-from cs50 import SQL
-from flask import flash, Flask, redirect, render_template, request, session
-from flask_session import Session
-from werkzeug.security import check_password_hash, generate_password_hash
+import click
+from flask import Blueprint, current_app, flash, Flask, g, make_response, redirect, render_template, request, Response, session, stream_with_context
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+from api import api
+from caching import apply_cache_policy, order_response, static_url
+from database import db
+from fragments import render_rows
+from helpers import apology, login_required, is_valid_email, process_files, usd, is_valid_order_id, get_form_data, load_order, set_admin
+from ingest import resolve_pending
+from live import broker, stream
+from listing import list_orders, load_row, parse_filters
+from migrations import check_query_plans, run_migrations
+from orders import apply_action, create_order, order_history, set_price, update_order
+from passwords import Busy, hasher
+from profiling import profiler
+from ratelimit import by_ip, by_username, limiter
+from reaper import collect_garbage, reaper
+from scheduler import DeadlineScheduler, run as run_scheduler
+from search import rebuild_search_index, search_orders
+from sessions import init_sessions
+from summary import order_summary, rebuild_counters
+from thumbnails import thumbnail, worker as thumbnail_worker
+from transfer import FORMATS, export_orders, import_orders
+from uploads import MAX_FILE_SIZE, MAX_REQUEST_SIZE, UploadRequest
+
+# The pages and commands of the app, create_app() registers them on the application
+views = Blueprint("views", __name__, cli_group=None)
 
-from helpers import apology, login_required, is_valid_email, process_files, usd, is_valid_order_id, get_form_data, user_or_admin
+# Folder to store uploaded files
+UPLOAD_FOLDER = 'static/uploads'
 
-# Configure application
-app = Flask(__name__)
 
-# Configure session to use filesystem (instead of signed cookies)
-app.config["SESSION_PERMANENT"] = False
-app.config["SESSION_TYPE"] = "filesystem"
-Session(app)
+def create_app(config=None):
+    """
+    Creates and configures the application, for `flask run`, `gunicorn 'app:create_app()'`, benchmarks and scripts.
 
-# Custom filter
-app.jinja_env.filters["usd"] = usd
+    Importing app.py only defines the routes. The database is chosen here, from DATABASE_URL unless
+    config says otherwise, and first connected to when its migrations are checked.
+    """
+    app = Flask(__name__)
 
-# Folder to store uploaded files
-UPLOAD_FOLDER = 'static/uploads'
+    app.config["DATABASE_URL"] = db.url
+    app.config["SESSION_PERMANENT"] = False
+    app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+
+    # Stream uploads to disk in chunks and refuse oversized requests before reading their body
+    app.request_class = UploadRequest
+    app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_SIZE
+    app.config['MAX_FILE_SIZE'] = MAX_FILE_SIZE
+
+    # Opt-in profiling of every request, shown to admins on /stats and, with PROFILE_METRICS, on /metrics.
+    # The routes in PROFILE_ROUTES (comma separated endpoints) also have a share of their requests sampled
+    # into folded stacks for flame graphs.
+    app.config["PROFILE"] = bool(os.environ.get("PROFILE"))
+    app.config["PROFILE_METRICS"] = bool(os.environ.get("PROFILE_METRICS"))
+
+    # Dashboards patch their rows as orders change with LIVE_UPDATES=1. Every open dashboard then holds
+    # a request open, which needs threaded or asynchronous workers, see live.py
+    app.config["LIVE_UPDATES"] = bool(os.environ.get("LIVE_UPDATES"))
 
-app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    # Login and registration attempts are rate limited unless RATE_LIMIT=0, such as for load tests from one address
+    app.config["RATE_LIMIT"] = os.environ.get("RATE_LIMIT", "1") != "0"
 
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///orders.db")
+    # Behind reverse proxies, PROXY_FIX is how many of them are in front of the app. The address, scheme and host
+    # they forward are then trusted, so the rate limits count the client's address instead of the proxy's
+    app.config["PROXY_FIX"] = int(os.environ.get("PROXY_FIX", "0"))
 
+    app.config.update(config or {})
+    db.configure(app.config["DATABASE_URL"])
 
-@app.after_request
+    if app.config["PROXY_FIX"]:
+        hops = app.config["PROXY_FIX"]
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=hops, x_proto=hops, x_host=hops)
+
+    # Configure server side sessions, stored in the database (or Redis) so every worker shares them
+    init_sessions(app)
+
+    # Custom filter
+    app.jinja_env.filters["usd"] = usd
+    app.jinja_env.filters["thumbnail"] = thumbnail
+    app.jinja_env.globals["static_url"] = static_url
+
+    app.register_blueprint(views)
+
+    # JSON API for scripts and the dashboard
+    app.register_blueprint(api)
+
+    if app.config["PROFILE"]:
+        profiler.init_app(app, db,
+                          sample_routes=[route for route in os.environ.get("PROFILE_ROUTES", "").split(",") if route],
+                          sample_rate=float(os.environ.get("PROFILE_SAMPLE_RATE", "0.1")),
+                          sample_folder=os.environ.get("PROFILE_FOLDER", "profiles"))
+
+    # Bring the schema of an existing database up to date
+    run_migrations(db)
+
+    # Delete removed uploads and collect orphaned ones in the background
+    reaper.start()
+
+    return app
+
+
+@views.cli.command("check-query-plans")
+def check_query_plans_command():
+    """Fail if any route query scans a table instead of using an index"""
+    failures = check_query_plans(db)
+    for name, detail in failures:
+        click.echo(f"{name}: {detail}")
+    if failures:
+        raise click.ClickException(f"{len(failures)} route queries do not use an index")
+    click.echo("All route queries use an index.")
+
+
+@views.cli.command("thumbnails")
+def thumbnails_command():
+    """Create the missing thumbnails of every reference image"""
+    paths = db.execute("""
+                       SELECT file_path FROM character_references
+                       UNION
+                       SELECT file_path FROM background_references
+                       """)
+    thumbnail_worker.enqueue([row["file_path"] for row in paths if os.path.exists(row["file_path"])])
+    thumbnail_worker.wait()
+    click.echo(f"Thumbnails are ready, {len(thumbnail_worker.failed)} images could not be read.")
+
+
+@views.cli.command("gc-uploads")
+@click.option("--grace-period", default=3600, show_default=True, help="Only reclaim files older than this many seconds.")
+def gc_uploads_command(grace_period):
+    """Delete uploads and thumbnails that no order refers to"""
+    report = collect_garbage(grace_period)
+    click.echo(f"Scanned {report['scanned']} files, reclaimed {report['files']} files "
+               f"({report['bytes']} bytes) in {report['seconds']:.2f}s.")
+
+
+@views.cli.command("resolve-uploads")
+def resolve_uploads_command():
+    """Settle the references left pending when the app stopped before storing their files"""
+    report = resolve_pending()
+    click.echo(f"{report['ready']} files were stored, {report['failed']} were lost and are marked failed.")
+
+
+@views.cli.command("rebuild-counters")
+def rebuild_counters_command():
+    """Recompute the dashboard summary counters from the orders"""
+    drifted = rebuild_counters()
+    click.echo(f"Counters rebuilt, {drifted} had drifted.")
+
+
+@views.cli.command("rebuild-search")
+def rebuild_search_command():
+    """Reindex every order for the search"""
+    orders = rebuild_search_index()
+    click.echo(f"Search index rebuilt, {orders} orders indexed.")
+
+
+@views.cli.command("expire-sessions")
+def expire_sessions_command():
+    """Delete the expired sessions"""
+    expired = current_app.session_interface.delete_expired_sessions()
+    click.echo(f"Deleted {expired} expired sessions.")
+
+
+@views.cli.command("export-orders")
+@click.option("--format", "file_format", type=click.Choice(FORMATS), default="csv", show_default=True)
+@click.option("--status", help="Only export the orders with this status.")
+@click.option("--output", type=click.File("w", encoding="utf-8", lazy=False), default="-",
+              help="File to write to, standard output by default.")
+def export_orders_command(file_format, status, output):
+    """Write every order with its palette and reference paths as CSV or JSON lines"""
+    for chunk in export_orders(file_format, status):
+        output.write(chunk)
+
+
+@views.cli.command("import-orders")
+@click.argument("file", type=click.File("r", encoding="utf-8"))
+@click.option("--format", "file_format", type=click.Choice(FORMATS), help="Guessed from the file name by default.")
+@click.option("--owner", help="Give every order to this user instead of the one in its username column.")
+@click.option("--keep-due-dates", is_flag=True, help="Accept due dates in the past, such as those of old orders.")
+@click.option("--batch-size", default=5000, show_default=True, help="Orders inserted at once.")
+def import_orders_command(file, file_format, owner, keep_due_dates, batch_size):
+    """Import orders from a CSV or JSON lines file, such as an export, as new pending orders"""
+    file_format = file_format or ("jsonl" if file.name.endswith((".jsonl", ".json")) else "csv")
+    report = import_orders(file, file_format, owner, keep_due_dates, batch_size)
+
+    for line, errors in report["rejected"][:20]:
+        click.echo(f"line {line}: {'; '.join(errors)}")
+    if len(report["rejected"]) > 20:
+        click.echo(f"... and {len(report['rejected']) - 20} more rejected rows")
+    click.echo(f"Imported {report['imported']} orders in {report['seconds']:.2f}s "
+               f"({report['imported'] / max(report['seconds'], 1e-9):.0f}/s), rejected {len(report['rejected'])} rows.")
+
+
+@views.cli.command("scheduler")
+@click.option("--interval", default=60, show_default=True, help="Seconds between two checks of the deadlines.")
+@click.option("--once", is_flag=True, help="Check the deadlines once and exit, such as from cron.")
+@click.option("--sink", type=click.File("a", encoding="utf-8"),
+              help="Append the queued notices to this file as JSON lines and mark them delivered.")
+def scheduler_command(interval, once, sink):
+    """Queue reminders of orders coming due and notices of overdue ones in the order_reminders outbox"""
+    run_scheduler(DeadlineScheduler(), interval, sink, once, report=lambda result: click.echo(
+        f"Loaded {result['loaded']} deadlines, re-read {result['changed']} written orders, "
+        f"queued {result['queued']} notices, delivered {result.get('delivered', 0)}, "
+        f"{result['waiting']} orders waiting ({result['seconds'] * 1000:.1f} ms)"))
+
+
+@views.cli.command("set-admin")
+@click.argument("username")
+@click.option("--revoke", is_flag=True, help="Remove the admin role instead of granting it.")
+def set_admin_command(username, revoke):
+    """Grant or revoke the admin role of a user"""
+    rows = db.execute("SELECT id FROM users WHERE username = ?", username)
+    if len(rows) != 1:
+        raise click.ClickException(f"no such user: {username}")
+    set_admin(rows[0]["id"], not revoke)
+    click.echo(f"{username} is {'no longer' if revoke else 'now'} an admin.")
+
+
+@views.after_app_request
 def after_request(response):
-    """Ensure responses aren't cached"""
-    response.headers["Cache-Control"] = "no-cache, no-store, must-revalidate"
-    response.headers["Expires"] = 0
-    response.headers["Pragma"] = "no-cache"
+    """Tell browsers what they may cache and for how long"""
+    apply_cache_policy(response)
+    # Number of order detail queries this request needed
+    if "order_queries" in g:
+        response.headers["X-Order-Queries"] = g.order_queries
     return response
 
 
-@app.route("/")
+@views.app_errorhandler(413)
+def request_too_large(error):
+    """Explain why an upload was refused"""
+    return apology("files too large", code=413)
+
+
+@views.route("/")
 @login_required
 def index():
     """View past orders for admins and users"""
 
-    user_id = session["user_id"]
-    is_admin = user_or_admin(user_id)
+    user_id = g.identity["id"]
+    is_admin = g.identity["is_admin"]
 
-    if is_admin:
-        past_orders = db.execute("""
-                                SELECT order_id,
-                                order_name,
-                                price,
-                                status,
-                                order_due_date,
-                                created_at
-                                FROM orders
-                                ORDER BY order_due_date ASC
-                                """)
+    filters = parse_filters(request.args, is_admin)
+    if not filters:
+        return apology("invalid filter", is_admin)
 
-    else:
-        past_orders = db.execute("""
-                                SELECT order_id,
-                                order_name,
-                                price,
-                                status,
-                                order_due_date,
-                                created_at
-                                FROM orders
-                                WHERE user_id = ?
-                                ORDER BY order_due_date ASC
-                                """, user_id)
-
-    for order in past_orders:
-        if not order["price"]:
-            order["price"] = '-'
-
-    return render_template("index.html", action_required=True, is_admin=is_admin,
-                           past_orders=past_orders, page_title="Orders!" if is_admin else "Your Orders!")
-
-
-@app.route("/handle-action", methods=["POST"])
+    # Users can only see their own orders
+    if not is_admin:
+        filters["user_id"] = user_id
+
+    past_orders, next_cursor = list_orders(**filters)
+    render_rows(past_orders, is_admin, action_required=True)
+
+    return render_template("index.html", action_required=True, is_admin=is_admin, past_orders=past_orders,
+                           filters=filters, next_cursor=next_cursor, page_title="Orders!" if is_admin else "Your Orders!")
+
+
+@views.route("/events")
+@login_required
+def events():
+    """Stream the changes to the orders on the dashboard as server-sent events"""
+    if not current_app.config["LIVE_UPDATES"]:
+        return apology("not found", g.identity["is_admin"], 404)
+
+    user_id = g.identity["id"]
+    is_admin = g.identity["is_admin"]
+
+    # The rows are rendered like on the page that listens, with or without the action buttons
+    action_required = request.args.get("action_required", "1") != "0"
+
+    def render(event):
+        # The order is read again once the change is committed, a deleted order has no row
+        row = load_row(event["order_id"])
+        if row is not None:
+            render_rows([row], is_admin, action_required)
+        return {**event, "row": row and str(row["row"])}
+
+    return Response(stream_with_context(stream(broker, user_id, is_admin, render)), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@views.route("/handle-action", methods=["POST"])
+@login_required
 def handle_action():
-    user_id = session["user_id"]
-    is_admin = user_or_admin(user_id)
+    user_id = g.identity["id"]
+    is_admin = g.identity["is_admin"]
 
     order_id = request.form.get("order_id")
     if not is_valid_order_id(is_admin, order_id):
@@ -88,132 +294,155 @@ def handle_action():
         else:
             return apology("unauthorized action")
     else:
-        # Get the action (accept, reject, or remove)
+        # Get the action (accept, reject, complete or remove)
         action = request.form.get("action")
 
-        if action == "accept":
-            # Handle the accept action
-            db.execute("UPDATE orders SET status = 'accepted' WHERE order_id = ?", order_id)
-            flash("Order accepted!")
-        elif action == "remove" or action == "reject":
-            # Handle the remove action
-            # Retrieve the file paths for the order
-            character_files = db.execute(
-                "SELECT file_path FROM character_references WHERE order_id = ?", order_id
-            )
-            background_files = db.execute(
-                "SELECT file_path FROM background_references WHERE order_id = ?", order_id
-            )
+        # Removed and rejected orders are deleted, their files are deleted in the background
+        try:
+            status = apply_action(int(order_id), action, user_id, is_admin)
+        except (LookupError, PermissionError, ValueError):
+            # Handle unexpected cases
+            return apology("unauthorized action", is_admin)
 
-            # Delete the files from the filesystem
-            for file in character_files:
-                try:
-                    os.remove(file["file_path"])  # Delete the character reference files
-                except FileNotFoundError:
-                    pass  # Ignore if file doesn't exist
-
-            for file in background_files:
-                try:
-                    os.remove(file["file_path"])  # Delete the background reference files
-                except FileNotFoundError:
-                    pass  # Ignore if file doesn't exist
-
-            # Remove the order from the database
-            db.execute("DELETE FROM orders WHERE order_id = ?", order_id)
+        if status is None:
             flash("Order deleted!")
-
-        elif action == "complete":
-            db.execute("UPDATE orders SET status = 'completed' WHERE order_id = ?", order_id)
-            flash("Order completed!")
         else:
-            # Handle unexpected cases
-            if is_admin:
-                return apology("unauthorized action", True)
-            else:
-                return apology("unauthorized action")
+            flash(f"Order {status}!")
 
         return redirect("/")
 
 
-@app.route("/view-details")
+@views.route("/view-details")
+@login_required
 def view_details():
     order_id = request.args.get("order_id")
 
-    user_id = session["user_id"]
-    is_admin = user_or_admin(user_id)
-
-    if not is_valid_order_id(is_admin, order_id):
-        if is_admin:
-            return apology("unauthorized action", True)
-        else:
-            return apology("unauthorized action")
+    user_id = g.identity["id"]
+    is_admin = g.identity["is_admin"]
 
-    else:
-        order = db.execute("SELECT * FROM orders WHERE order_id = ?", order_id)
+    # Users can only view their own orders
+    details = load_order(order_id, None if is_admin else user_id)
+    if not details:
+        return apology("unauthorized action", is_admin)
 
-        order = order[0]
-        order["has_background"] = order["has_background"] == 'TRUE'
+    return order_response(details["order"], lambda: render_template(
+        "edit-order-price.html", view_only=True, **details, page_title="View Order!", is_admin=is_admin),
+        "view-details", is_admin,
+        references=details["character_references"] + details["background_references"])
 
-        colors = db.execute("SELECT DISTINCT color_hex FROM color_palette WHERE order_id = ?", order_id)
 
-        character_references = db.execute(
-            "SELECT file_path FROM character_references WHERE order_id = ?", order_id)
-        background_references = db.execute(
-            "SELECT file_path FROM background_references WHERE order_id = ?", order_id)
+@views.route("/history")
+@login_required
+def history():
+    """Show how an order got to its current status"""
+    order_id = request.args.get("order_id")
 
-        user_id = db.execute("""
-                                SELECT user_id
-                                FROM orders
-                                WHERE order_id = ?
-                                """, order_id)
-        user_id = user_id[0]["user_id"]
+    is_admin = g.identity["is_admin"]
 
-        user_info = db.execute("""
-                                SELECT username, email
-                                FROM users
-                                WHERE id = ?
-                                """, user_id)
-        user_info = user_info[0]
+    # Users can only see the history of their own orders
+    if not is_valid_order_id(is_admin, order_id):
+        return apology("unauthorized action", is_admin)
 
-        return render_template("edit-order-price.html", view_only=True, user_info=user_info, order=order, colors=colors, character_references=character_references,
-                               background_references=background_references, page_title="View Order!", is_admin=is_admin)
+    return render_template("history.html", order_id=int(order_id), events=order_history(int(order_id)),
+                           is_admin=is_admin, page_title="Order History!")
 
 
-@app.route("/accepted-orders")
+@views.route("/accepted-orders")
 @login_required
 def view_accepted_orders():
-    user_id = session["user_id"]
-    is_admin = user_or_admin(user_id)
+    is_admin = g.identity["is_admin"]
 
     if not is_admin:
         return apology("unauthorized action")
 
-    past_orders = db.execute("""
-                                SELECT
-                                order_id,
-                                order_name,
-                                price,
-                                status,
-                                order_due_date,
-                                created_at
-                                FROM orders
-                                WHERE status = 'accepted'
-                                ORDER BY order_due_date ASC
-                                """)
+    filters = parse_filters(request.args, is_admin)
+    if not filters:
+        return apology("invalid filter", True)
+
+    # This page only ever lists accepted orders
+    filters["status"] = "accepted"
+
+    past_orders, next_cursor = list_orders(**filters)
+    render_rows(past_orders, is_admin, action_required=False)
 
-    for order in past_orders:
-        if not order["price"]:
-            order["price"] = '-'
+    return render_template("index.html", action_required=False, is_admin=True, past_orders=past_orders,
+                           filters=filters, next_cursor=next_cursor, page_title="Accepted Orders!")
 
-    return render_template("index.html", action_required=False, is_admin=True, past_orders=past_orders, page_title="Accepted Orders!")
 
+@views.route("/summary")
+@login_required
+def summary():
+    """Show the number of orders and revenue by status and due week"""
+    if not g.identity["is_admin"]:
+        return apology("unauthorized action")
+
+    return render_template("summary.html", summary=order_summary(), is_admin=True, page_title="Summary!")
 
-@app.route("/place-order", methods=["GET", "POST"])
+
+@views.route("/search")
+@login_required
+def search():
+    """Search the names and descriptions of the orders"""
+    user_id = g.identity["id"]
+    is_admin = g.identity["is_admin"]
+
+    q = request.args.get("q", "").strip()
+    try:
+        page = max(1, int(request.args.get("page", 1)))
+    except ValueError:
+        return apology("invalid page", is_admin)
+
+    # Users can only find their own orders
+    results, has_next = search_orders(q, None if is_admin else user_id, page)
+
+    return render_template("search.html", q=q, page=page, results=results, has_next=has_next,
+                           is_admin=is_admin, page_title="Search!")
+
+
+@views.route("/export-orders")
+@login_required
+def export_orders_view():
+    """Download every order as CSV or JSON lines"""
+    if not g.identity["is_admin"]:
+        return apology("unauthorized action")
+
+    file_format = request.args.get("format", "csv")
+    if file_format not in FORMATS:
+        return apology("invalid format", True)
+
+    # Streamed as it is read, the export is never held in memory
+    mimetype = "text/csv" if file_format == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(export_orders(file_format, request.args.get("status") or None)),
+                    mimetype=mimetype, headers={"Content-Disposition": f"attachment; filename=orders.{file_format}"})
+
+
+@views.route("/stats")
+@login_required
+def stats():
+    """Show how long the recent requests took and how many queries they ran"""
+    if not g.identity["is_admin"]:
+        return apology("unauthorized action")
+    if not profiler.enabled:
+        return apology("profiling is off, set PROFILE=1", True)
+
+    return render_template("stats.html", stats=profiler.summary(), is_admin=True, page_title="Stats!")
+
+
+@views.route("/metrics")
+def metrics():
+    """Request metrics in the Prometheus text format"""
+    if not (profiler.enabled and current_app.config["PROFILE_METRICS"]):
+        return apology("not found", code=404)
+    return profiler.prometheus(), 200, {"Content-Type": "text/plain; version=0.0.4"}
+
+
+@views.route("/place-order", methods=["GET", "POST"])
+@login_required
 def place_order():
     """ Place order """
 
-    user_id = session["user_id"]
-    is_admin = user_or_admin(user_id)
+    user_id = g.identity["id"]
+    is_admin = g.identity["is_admin"]
 
     if is_admin:
         return apology("unauthorized action", True)
@@ -224,78 +453,18 @@ def place_order():
         if not isinstance(form_data, dict):
             return form_data  # Return the apology response directly
 
-        # Assign individual values to variables
-        order_name = form_data["order_name"]
-        character_part = form_data["character_part"]
-        preferred_style = form_data["preferred_style"]
-        pose_view = form_data["pose_view"]
-        pose_description = form_data["pose_description"]
-        character_features_description = form_data["character_features_description"]
-        outfit_description = form_data["outfit_description"]
-        has_background = form_data["has_background"]
-        background_description = form_data["background_description"]
-        due_date = form_data["due_date"]
-        colors = form_data["colors"]
         # Handle the submitted images
         character_references = process_files('character_references[]', os.path.join(
-            app.config['UPLOAD_FOLDER'], 'character_references'))
-        if has_background:
+            current_app.config['UPLOAD_FOLDER'], 'character_references'))
+        if form_data["has_background"] == 'TRUE':
             background_references = process_files('background_references[]', os.path.join(
-                app.config['UPLOAD_FOLDER'], 'background_references'))
+                current_app.config['UPLOAD_FOLDER'], 'background_references'))
         else:
-            background_references = []
-
-        # Insert data to the database
-        db.execute("""
-                    INSERT INTO orders (
-                    user_id,
-                    order_name,
-                    character_part,
-                    preferred_style,
-                    pose_view,
-                    pose_description,
-                    character_features_description,
-                    outfit_description,
-                    has_background,
-                    background_description,
-                    order_due_date
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
-                    """, user_id,
-                   order_name,
-                   character_part,
-                   preferred_style,
-                   pose_view,
-                   pose_description,
-                   character_features_description,
-                   outfit_description,
-                   has_background,
-                   background_description,
-                   due_date)
-
-        # Get the last order
-        order_id = db.execute("SELECT MAX(order_id) AS order_id FROM orders")
-        order_id = order_id[0]["order_id"]
-
-        # Add the color pallet of the order
-        for color in colors:
-            db.execute("""
-                    INSERT INTO color_palette (order_id, color_hex)
-                    VALUES (?, ?)
-                    """, order_id, color)
-
-        # Save file paths to the character references table
-        for path in character_references:
-            db.execute("""
-                    INSERT INTO character_references (order_id, file_path)
-                    VALUES (?, ?)
-                    """, order_id, path)
-
-        # Save file paths to the background references table
-        for path in background_references:
-            db.execute("""
-                    INSERT INTO background_references (order_id, file_path)
-                    VALUES (?, ?)
-                    """, order_id, path)
+            background_references = {}
+
+        # Insert the order, its color pallet and references in one transaction,
+        # the received files are stored in the background once it is committed
+        create_order(user_id, form_data, character_references, background_references)
 
         # Handle valid form submission
         flash("Order submitted successfully!")
@@ -306,11 +475,12 @@ def place_order():
         return render_template("place-order.html", page_title="Place Your Order!")
 
 
-@app.route("/edit-order", methods=["GET", "POST"])
+@views.route("/edit-order", methods=["GET", "POST"])
+@login_required
 def edit_order():
     """ Edit order """
-    user_id = session["user_id"]
-    is_admin = user_or_admin(user_id)
+    user_id = g.identity["id"]
+    is_admin = g.identity["is_admin"]
 
     if is_admin:
         return apology("unauthorized action", True)
@@ -321,71 +491,25 @@ def edit_order():
         if not isinstance(form_data, dict):
             return form_data  # Return the apology response directly
 
-        # Assign individual values to variables
-        order_name = form_data["order_name"]
-        character_part = form_data["character_part"]
-        preferred_style = form_data["preferred_style"]
-        pose_view = form_data["pose_view"]
-        pose_description = form_data["pose_description"]
-        character_features_description = form_data["character_features_description"]
-        outfit_description = form_data["outfit_description"]
-        has_background = form_data["has_background"]
-        background_description = form_data["background_description"]
-        due_date = form_data["due_date"]
-        colors = form_data["colors"]
+        order_id = request.form.get("order_id")
+        if not is_valid_order_id(False, order_id):
+            return apology("unauthorized action")
+
         # Handle the submitted images
         character_references = process_files('character_references[]', os.path.join(
-            app.config['UPLOAD_FOLDER'], 'character_references'))
-        if has_background:
+            current_app.config['UPLOAD_FOLDER'], 'character_references'))
+        if form_data["has_background"] == 'TRUE':
             background_references = process_files('background_references[]', os.path.join(
-                app.config['UPLOAD_FOLDER'], 'background_references'))
+                current_app.config['UPLOAD_FOLDER'], 'background_references'))
         else:
-            background_references = []
-
-        order_id = request.form.get("order_id")
-        if not is_valid_order_id(False, order_id):
-            return apology("unauthorized action")
+            background_references = {}
 
-        # Update the order
-        db.execute("""
-                    UPDATE orders
-                    SET
-                    order_name = ?,
-                    character_part = ?,
-                    preferred_style = ?,
-                    pose_view = ?,
-                    pose_description = ?,
-                    character_features_description = ?,
-                    outfit_description = ?,
-                    has_background = ?,
-                    background_description = ?,
-                    order_due_date = ?
-                    WHERE order_id = ?;
-                    """, order_name, character_part, preferred_style,
-                   pose_view, pose_description, character_features_description,
-                   outfit_description, has_background, background_description,
-                   due_date, order_id)
-
-        # Add the color pallet of the order
-        for color in colors:
-            db.execute("""
-                        INSERT INTO color_palette (order_id, color_hex)
-                        VALUES (?, ?)
-                        """, order_id, color)
-
-        # Save file paths to the character references table
-        for path in character_references:
-            db.execute("""
-                    INSERT INTO character_references (order_id, file_path)
-                    VALUES (?, ?)
-                    """, order_id, path)
-
-        # Save file paths to the background references table
-        for path in background_references:
-            db.execute("""
-                    INSERT INTO background_references (order_id, file_path)
-                    VALUES (?, ?)
-                    """, order_id, path)
+        # Update the order, its color pallet and references in one transaction.
+        # Files received for an order that can no longer be edited are collected with the abandoned uploads.
+        try:
+            update_order(int(order_id), user_id, form_data, character_references, background_references)
+        except ValueError:
+            return apology("order can no longer be edited")
 
         # Handle valid form submission
         flash("Order edited successfully!")
@@ -394,29 +518,23 @@ def edit_order():
 
     else:
         order_id = request.args.get("order_id")
-        if not is_valid_order_id(False, order_id):
+        details = load_order(order_id, user_id)
+        if not details:
             return apology("unauthorized action")
-        else:
-            order = db.execute("SELECT * FROM orders WHERE order_id = ?", order_id)
-            order = order[0]
-            order["has_background"] = order["has_background"] == 'TRUE'
-
-            colors = db.execute("SELECT DISTINCT color_hex FROM color_palette WHERE order_id = ?", order_id)
 
-            character_references = db.execute(
-                "SELECT file_path FROM character_references WHERE order_id = ?", order_id)
-            background_references = db.execute(
-                "SELECT file_path FROM background_references WHERE order_id = ?", order_id)
+        return order_response(details["order"], lambda: render_template(
+            "edit-order.html", order=details["order"], colors=details["colors"],
+            character_references=details["character_references"],
+            background_references=details["background_references"], page_title="Edit Your Order!"),
+            "edit-order",
+            references=details["character_references"] + details["background_references"])
 
-            return render_template("edit-order.html", order=order, colors=colors, character_references=character_references,
-                                   background_references=background_references, page_title="Edit Your Order!")
 
-
-@app.route("/edit-order-price", methods=["GET", "POST"])
+@views.route("/edit-order-price", methods=["GET", "POST"])
 @login_required
 def edit_order_price():
-    user_id = session["user_id"]
-    is_admin = user_or_admin(user_id)
+    user_id = g.identity["id"]
+    is_admin = g.identity["is_admin"]
 
     if not is_admin:
         return apology("unauthorized action")
@@ -442,48 +560,34 @@ def edit_order_price():
             return apology("unauthorized action", True)
 
         else:
-            # Update price and status
-            db.execute("UPDATE orders SET price = ?, status = ? WHERE order_id = ?",
-                       new_price, 'reviewed', order_id)
+            # Update price and status, unless the price was accepted in the meantime
+            try:
+                set_price(int(order_id), new_price, user_id)
+            except ValueError:
+                return apology("order was already accepted", True)
             flash("Price edited!")
             return redirect("/")
 
     else:
         order_id = request.args.get("order_id")
-        if not is_valid_order_id(True, order_id):
+        details = load_order(order_id)
+        if not details:
             return apology("unauthorized action", True)
 
-        else:
-            order = db.execute("SELECT * FROM orders WHERE order_id = ?", order_id)
-            order = order[0]
-            order["has_background"] = order["has_background"] == 'TRUE'
-
-            colors = db.execute("SELECT DISTINCT color_hex FROM color_palette WHERE order_id = ?", order_id)
-
-            character_references = db.execute(
-                "SELECT file_path FROM character_references WHERE order_id = ?", order_id)
-            background_references = db.execute(
-                "SELECT file_path FROM background_references WHERE order_id = ?", order_id)
-
-            user_id = db.execute("""
-                                 SELECT user_id
-                                 FROM orders
-                                 WHERE order_id = ?
-                                 """, order_id)
-            user_id = user_id[0]["user_id"]
+        return order_response(details["order"], lambda: render_template(
+            "edit-order-price.html", view_only=False, **details, page_title="Edit Order!", is_admin=True),
+            "edit-order-price",
+            references=details["character_references"] + details["background_references"])
 
-            user_info = db.execute("""
-                                    SELECT username, email
-                                    FROM users
-                                    WHERE id = ?
-                                    """, user_id)
-            user_info = user_info[0]
 
-            return render_template("edit-order-price.html", view_only=False, user_info=user_info, order=order, colors=colors, character_references=character_references,
-                                   background_references=background_references, page_title="Edit Order!", is_admin=True)
+def too_many_attempts(wait):
+    """Turn away a login or registration until the client may try again"""
+    response = make_response(apology("too many attempts, try again later", code=429))
+    response.headers["Retry-After"] = str(max(1, round(wait)))
+    return response
 
 
-@app.route("/login", methods=["GET", "POST"])
+@views.route("/login", methods=["GET", "POST"])
 def login():
     """Log user in"""
 
@@ -500,15 +604,23 @@ def login():
         elif not request.form.get("password"):
             return apology("must provide password")
 
+        # Cap the passwords checked per address and per account, whoever is guessing
+        wait = current_app.config["RATE_LIMIT"] and limiter.allow((by_ip, request.remote_addr),
+                                                          (by_username, request.form.get("username")))
+        if wait:
+            return too_many_attempts(wait)
+
         # Query database for username
         rows = db.execute(
             "SELECT * FROM users WHERE username = ?", request.form.get("username")
         )
 
-        # Ensure username exists and password is correct
-        if len(rows) != 1 or not check_password_hash(
-            rows[0]["hash"], request.form.get("password")
-        ):
+        # Ensure username exists and password is correct, hashing runs in the password processes
+        try:
+            valid = len(rows) == 1 and hasher.check(rows[0]["hash"], request.form.get("password"))
+        except Busy:
+            return too_many_attempts(1)
+        if not valid:
             return apology("invalid username and/or password")
 
         # Remember which user has logged in
@@ -522,7 +634,7 @@ def login():
         return render_template("login.html", page_title="Login!")
 
 
-@app.route("/logout")
+@views.route("/logout")
 def logout():
     """Log user out"""
 
@@ -533,7 +645,7 @@ def logout():
     return redirect("/")
 
 
-@app.route("/register", methods=["GET", "POST"])
+@views.route("/register", methods=["GET", "POST"])
 def register():
     """Register user"""
 
@@ -560,20 +672,29 @@ def register():
         if not is_valid_email(request.form.get("email")):
             return apology("invalid email")
 
-        # Error 4: Email is already taken
-        emails = db.execute("SELECT email FROM users")
-        emails = [email["email"] for email in emails]
-        if request.form.get("email") in emails:
+        # Error 4: Email is already taken, looked up in the unique index of emails
+        if db.execute("SELECT 1 FROM users WHERE email = ?", request.form.get("email")):
             return apology("email already taken")
 
+        # Hashing a password is slow on purpose, cap how often one address can make us do it
+        wait = current_app.config["RATE_LIMIT"] and limiter.allow((by_ip, request.remote_addr))
+        if wait:
+            return too_many_attempts(wait)
+        try:
+            password_hash = hasher.hash(request.form.get("password"))
+        except Busy:
+            return too_many_attempts(1)
+
         # Error 5: If username is already taken, if not insert the user
         try:
             db.execute(
                 "INSERT INTO users (username, hash, email) VALUES (?, ?, ?)",
-                request.form.get("username"), generate_password_hash(
-                    request.form.get("password")), request.form.get("email")
+                request.form.get("username"), password_hash, request.form.get("email")
             )
-        except ValueError:
+        except ValueError as error:
+            # Someone else may have taken the email since it was checked
+            if "email" in str(error):
+                return apology("email already taken")
             return apology("username already taken")
 
         # Log the user in
@@ -591,7 +712,7 @@ def register():
         return render_template("register.html", page_title="Register!")
 
 
-@app.route("/contact-me")
+@views.route("/contact-me")
 def contact_me():
     """Show the contact information"""
 
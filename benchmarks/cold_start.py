@@ -0,0 +1,105 @@
+"""
+Cold start of the app: how long a fresh worker process takes to import app.py, create the application
+and answer its first requests, against a scratch database:
+
+    python benchmarks/cold_start.py --runs 20
+    python benchmarks/cold_start.py --imports 15
+
+Every run is a new Python process, as when a server spawns a worker or a test run starts.
+With --imports the modules that take longest to import are listed too, from python -X importtime.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from concurrency import PASSWORD, ROOT, create_database
+
+# Runs in each fresh process, prints the seconds every phase took as JSON
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+phases = {}
+
+def lap(name):
+    global start
+    now = time.perf_counter()
+    phases[name] = now - start
+    start = now
+
+sys.path.insert(0, ROOT)
+from app import create_app
+lap("import")
+app = create_app({"DATABASE_URL": DATABASE_URL, "RATE_LIMIT": False})
+lap("create_app")
+client = app.test_client()
+assert client.get("/login").status_code == 200
+lap("first page")
+assert client.post("/login", data={"username": "client", "password": PASSWORD}).status_code == 302
+lap("first login")
+assert client.get("/").status_code == 200
+lap("dashboard")
+print(json.dumps(phases))
+"""
+
+
+def probe(directory, database_url):
+    """ Starts a new interpreter running the probe, returns the seconds of each phase and of the whole process """
+    code = f"ROOT = {ROOT!r}\nDATABASE_URL = {database_url!r}\nPASSWORD = {PASSWORD!r}\n{PROBE}"
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", code], cwd=directory, capture_output=True, text=True, check=True)
+    phases = json.loads(result.stdout.splitlines()[-1])
+    phases["process"] = time.perf_counter() - start
+    return phases
+
+
+def slowest_imports(directory, count):
+    """ Returns (cumulative seconds, module) of the modules that take longest to import with app.py """
+    code = f"import sys\nsys.path.insert(0, {ROOT!r})\nimport app"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", code], cwd=directory,
+                            capture_output=True, text=True, check=True)
+
+    modules = []
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, module = line[len("import time:"):].split("|")
+        modules.append((int(cumulative) / 1e6, module.rstrip()))
+    return sorted(modules, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10, help="fresh processes started")
+    parser.add_argument("--orders", type=int, default=100, help="orders seeded, some of them are on the dashboard")
+    parser.add_argument("--imports", type=int, default=0, help="also list this many of the slowest imports")
+    arguments = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="orders-benchmark-")
+    path = os.path.join(directory, "orders.db")
+    create_database(path, arguments.orders)
+    database_url = f"sqlite:///{path}"
+
+    # The first run migrates the scratch database and compiles the bytecode, it is not counted
+    probe(directory, database_url)
+    runs = [probe(directory, database_url) for _ in range(arguments.runs)]
+
+    print(f"{'phase':>12} {'min':>9} {'median':>9} {'max':>9}")
+    for phase in runs[0]:
+        values = [run[phase] for run in runs]
+        print(f"{phase:>12} {min(values) * 1000:7.1f}ms {statistics.median(values) * 1000:7.1f}ms "
+              f"{max(values) * 1000:7.1f}ms")
+
+    if arguments.imports:
+        print()
+        for seconds, module in slowest_imports(directory, arguments.imports):
+            print(f"{seconds * 1000:7.1f}ms {module}")
+
+
+if __name__ == "__main__":
+    main()
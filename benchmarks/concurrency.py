@@ -0,0 +1,147 @@
+"""
+Read throughput of the order listing while orders are being written.
+
+The app is served by Werkzeug's multi-threaded WSGI server against a scratch database
+created from orders.sql. Reader threads load the admin dashboard while writer threads
+place orders, run it once per journal mode to compare:
+
+    python benchmarks/concurrency.py --journal-mode wal
+    python benchmarks/concurrency.py --journal-mode delete
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import requests
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "benchmark"
+
+
+def create_database(path, orders):
+    """ Creates the schema and seeds an admin, a client and their orders """
+    connection = sqlite3.connect(path)
+    with open(os.path.join(ROOT, "orders.sql")) as schema:
+        connection.executescript(schema.read())
+
+    password_hash = generate_password_hash(PASSWORD)
+    connection.execute("INSERT INTO users (username, hash, email, is_admin) VALUES ('admin', ?, 'admin@example.com', 1)",
+                       (password_hash,))
+    connection.execute("INSERT INTO users (username, hash, email, is_admin) VALUES ('client', ?, 'client@example.com', 0)",
+                       (password_hash,))
+
+    today = date.today()
+    connection.executemany("""
+                           INSERT INTO orders (user_id, order_name, character_part, preferred_style, pose_view,
+                           pose_description, has_background, order_due_date)
+                           VALUES (2, ?, 'Head', 'Chibi', 'Front View', 'Waving', 'FALSE', ?)
+                           """, ((f"Order {i}", (today + timedelta(days=i % 365)).isoformat()) for i in range(orders)))
+    connection.commit()
+    connection.close()
+
+
+def order_form():
+    """ A valid place-order form without references """
+    return {
+        "order_name": "Benchmark",
+        "character_part": "Head",
+        "preferred_style": "Chibi",
+        "pose_view": "Front View",
+        "pose_description": "Waving",
+        "character_features_description": "Smiling",
+        "outfit_description": "Dress",
+        "colors[]": ["#000000", "#ffffff"],
+        "background": "without-background",
+        "due_date": (date.today() + timedelta(days=30)).isoformat(),
+    }
+
+
+def login(base, username):
+    """ Returns an HTTP session logged in as username """
+    client = requests.Session()
+    client.post(f"{base}/login", data={"username": username, "password": PASSWORD})
+    return client
+
+
+def worker(client, request, deadline, latencies, errors):
+    """ Sends requests until the deadline """
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = request(client)
+        if response.status_code >= 400:
+            errors.append(response.status_code)
+        else:
+            latencies.append(time.perf_counter() - start)
+
+
+def percentile(values, fraction):
+    """ Returns the value below which the given fraction of the values fall """
+    if not values:
+        return 0
+    return statistics.quantiles(values, n=100)[int(fraction * 100) - 1] if len(values) > 1 else values[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--orders", type=int, default=2000, help="orders seeded before the run")
+    parser.add_argument("--readers", type=int, default=8)
+    parser.add_argument("--writers", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=10)
+    parser.add_argument("--journal-mode", default="wal", choices=["wal", "delete"])
+    arguments = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="orders-benchmark-")
+    path = os.path.join(directory, "orders.db")
+    create_database(path, arguments.orders)
+
+    # Sessions are written to the scratch directory
+    os.chdir(directory)
+    sys.path.insert(0, ROOT)
+    from app import create_app
+    app = create_app({"DATABASE_URL": f"sqlite:///{path}?journal_mode={arguments.journal_mode}"})
+
+    # Keep the per-request log lines out of the results
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base = f"http://127.0.0.1:{server.server_port}"
+
+    # Log in before the clock starts, the first login also starts the password hashing processes
+    readers = [login(base, "admin") for _ in range(arguments.readers)]
+    writers = [login(base, "client") for _ in range(arguments.writers)]
+
+    reads, writes, errors = [], [], []
+    deadline = time.perf_counter() + arguments.seconds
+    threads = [threading.Thread(target=worker, args=(client, lambda client: client.get(f"{base}/"),
+                                                     deadline, reads, errors))
+               for client in readers]
+    threads += [threading.Thread(target=worker, args=(client,
+                                                      lambda client: client.post(f"{base}/place-order", data=order_form()),
+                                                      deadline, writes, errors))
+                for client in writers]
+
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    server.shutdown()
+
+    print(f"journal mode: {arguments.journal_mode}, {arguments.readers} readers, {arguments.writers} writers, "
+          f"{arguments.seconds:g}s, {arguments.orders} seeded orders")
+    for name, latencies in (("reads", reads), ("writes", writes)):
+        print(f"{name:>7}: {len(latencies) / arguments.seconds:8.1f}/s  "
+              f"p50 {percentile(latencies, 0.50) * 1000:7.1f} ms  p95 {percentile(latencies, 0.95) * 1000:7.1f} ms")
+    print(f" errors: {len(errors)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,44 @@
+"""
+Cost of validating one order form, valid and with every field wrong:
+
+    python benchmarks/form_validation.py --number 100000
+"""
+import argparse
+import sys
+import timeit
+
+from werkzeug.datastructures import MultiDict
+
+from concurrency import ROOT, order_form
+
+sys.path.insert(0, ROOT)
+from validation import validate_order  # noqa: E402
+
+
+def forms():
+    """ (name, data, colors) of the forms validated """
+    valid = order_form()
+    with_background = {**valid, "background": "with-background", "background_description": "A castle at night"}
+    invalid = {**valid, "order_name": "", "character_part": "Tail", "pose_view": "Top View", "background": "",
+               "due_date": "2000-01-01", "colors[]": ["#000000", "black"]}
+
+    for name, form in (("valid", valid), ("with background", with_background), ("invalid", invalid)):
+        # The same MultiDict the order form arrives in
+        data = MultiDict(form)
+        yield name, data, data.getlist("colors[]")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--number", type=int, default=50000, help="validations per form and repeat")
+    parser.add_argument("--repeat", type=int, default=5, help="the best of this many repeats is reported")
+    arguments = parser.parse_args()
+
+    for name, data, colors in forms():
+        best = min(timeit.repeat(lambda: validate_order(data, colors), number=arguments.number, repeat=arguments.repeat))
+        errors = validate_order(data, colors)[1]
+        print(f"{name:>16}: {best / arguments.number * 1e6:6.2f} us per form, {len(errors)} errors")
+
+
+if __name__ == "__main__":
+    main()
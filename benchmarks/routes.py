@@ -0,0 +1,326 @@
+"""
+Latency, throughput and query counts of the main routes, against a seeded scratch database.
+
+A scratch orders.db is seeded with synthetic users, orders, palettes and reference files
+(the same data for the same --seed), then every route is driven through Flask's test client,
+through a multi-threaded WSGI server on a local port, or both:
+
+    python benchmarks/routes.py --mode both --requests 200
+    python benchmarks/routes.py --save-baseline benchmarks/baseline.json
+    python benchmarks/routes.py --baseline benchmarks/baseline.json --tolerance 0.25
+
+With --baseline the results are compared with an earlier run, and the exit status is 1
+if the p95 latency or the query count of a route got worse by more than the tolerance.
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import os
+import random
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from datetime import date, timedelta
+
+import requests
+from werkzeug.security import generate_password_hash
+from werkzeug.serving import make_server
+
+from concurrency import PASSWORD, ROOT, order_form, percentile
+
+ROUTES = ["login", "index", "view_details", "place_order", "edit_order", "handle_action"]
+
+COLORS = ["#000000", "#ffffff", "#ff0000", "#00ff00", "#0000ff", "#ffade1", "#470000", "#ffd700"]
+WORDS = "happy sad girl boy standing sitting red dress armor cape forest castle night sky sword smile".split()
+
+# Server-Timing header the profiler adds to every response, see profiling.py
+QUERIES = re.compile(r'desc="(\d+) queries"')
+
+
+def png(seed):
+    """ Returns a small valid PNG, different for every seed """
+    def chunk(kind, data):
+        return len(data).to_bytes(4, "big") + kind + data + zlib.crc32(kind + data).to_bytes(4, "big")
+
+    width = height = 16
+    pixel = bytes([seed % 256, seed // 256 % 256, seed // 65536 % 256])
+    rows = b"".join(b"\x00" + pixel * width for _ in range(height))
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", width.to_bytes(4, "big") + height.to_bytes(4, "big") + b"\x08\x02\x00\x00\x00")
+            + chunk(b"IDAT", zlib.compress(rows)) + chunk(b"IEND", b""))
+
+
+def seed_database(directory, users, orders, files, seed):
+    """
+    Creates orders.db in directory with an admin and users clients, their orders with palettes
+    and references, and the reference files themselves. Returns the IDs of the orders by user.
+    """
+    rng = random.Random(seed)
+    connection = sqlite3.connect(os.path.join(directory, "orders.db"))
+    with open(os.path.join(ROOT, "orders.sql")) as schema:
+        connection.executescript(schema.read())
+
+    # Hashing is slow on purpose, every account shares the same password
+    password_hash = generate_password_hash(PASSWORD)
+    connection.execute("INSERT INTO users (username, hash, email, is_admin) VALUES ('admin', ?, 'admin@example.com', 1)",
+                       (password_hash,))
+    connection.executemany("INSERT INTO users (username, hash, email, is_admin) VALUES (?, ?, ?, 0)",
+                           ((f"client{i}", password_hash, f"client{i}@example.com") for i in range(users)))
+
+    # Reference images stored like uploads.py stores them, under the SHA-256 of their content
+    paths = []
+    for i in range(files):
+        content = png(i)
+        digest = hashlib.sha256(content).hexdigest()
+        path = os.path.join("static/uploads/character_references", digest[:2], f"{digest}.png")
+        os.makedirs(os.path.join(directory, os.path.dirname(path)), exist_ok=True)
+        with open(os.path.join(directory, path), "wb") as file:
+            file.write(content)
+        paths.append(path)
+
+    today = date.today()
+    rows = []
+    for i in range(orders):
+        description = lambda: " ".join(rng.choices(WORDS, k=rng.randint(4, 16)))
+        rows.append((rng.randint(2, users + 1), f"Order {i} {rng.choice(WORDS)}", description(), description(),
+                     description(), (today + timedelta(days=rng.randint(1, 365))).isoformat()))
+    connection.executemany("""
+                           INSERT INTO orders (user_id, order_name, character_part, preferred_style, pose_view,
+                           pose_description, character_features_description, outfit_description, has_background,
+                           order_due_date)
+                           VALUES (?, ?, 'Head', 'Chibi', 'Front View', ?, ?, ?, 'FALSE', ?)
+                           """, rows)
+
+    order_ids = [row[0] for row in connection.execute("SELECT order_id FROM orders ORDER BY order_id")]
+    connection.executemany("INSERT INTO color_palette (order_id, color_hex) VALUES (?, ?)",
+                           ((order_id, color) for order_id in order_ids for color in rng.sample(COLORS, 3)))
+    connection.executemany("INSERT INTO character_references (order_id, file_path) VALUES (?, ?)",
+                           ((order_id, path) for order_id in order_ids for path in rng.sample(paths, min(2, files))))
+    connection.commit()
+
+    owners = {}
+    for order_id, user_id in connection.execute("SELECT order_id, user_id FROM orders ORDER BY order_id"):
+        owners.setdefault(user_id, []).append(order_id)
+    connection.close()
+    return owners
+
+
+class Scenario:
+    """ The requests of a run: which user sends them and what each route is asked """
+
+    def __init__(self, owners, seed):
+        self.rng = random.Random(seed)
+        # Every other order of each user is only ever read, the rest are edited or removed once each
+        self.readable = [order_id for ids in owners.values() for order_id in ids[::2]]
+        self.writable = {user_id: ids[1::2] for user_id, ids in owners.items()}
+        self._lock = threading.Lock()
+
+    def take_order(self, user_id):
+        """ Returns an order of the user no earlier request edited or removed, None when they ran out """
+        with self._lock:
+            return self.writable[user_id].pop() if self.writable[user_id] else None
+
+    def request(self, route, user_id):
+        """ Returns (method, path, data, files) for one request to a route as the given client """
+        if route == "login":
+            return "POST", "/login", {"username": f"client{user_id - 2}", "password": PASSWORD}, None
+        if route == "index":
+            return "GET", "/", None, None
+        if route == "view_details":
+            with self._lock:
+                order_id = self.rng.choice(self.readable)
+            return "GET", f"/view-details?order_id={order_id}", None, None
+        if route == "place_order":
+            with self._lock:
+                image = png(self.rng.randrange(1 << 24))
+            return "POST", "/place-order", order_form(), {"character_references[]": ("reference.png", image)}
+        if route == "edit_order":
+            return "POST", "/edit-order", {**order_form(), "order_id": self.take_order(user_id)}, None
+        if route == "handle_action":
+            return "POST", "/handle-action", {"order_id": self.take_order(user_id), "action": "remove"}, None
+        raise ValueError(route)
+
+
+def queries(response_headers):
+    """ Returns the number of SQL statements a response needed """
+    match = QUERIES.search(response_headers.get("Server-Timing", ""))
+    return int(match.group(1)) if match else 0
+
+
+def summarize(route, latencies, query_counts, errors, seconds):
+    return {
+        "route": route,
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput": len(latencies) / seconds if seconds else 0,
+        "p50": percentile(latencies, 0.50) * 1000,
+        "p95": percentile(latencies, 0.95) * 1000,
+        "p99": percentile(latencies, 0.99) * 1000,
+        "queries": sum(query_counts) / len(query_counts) if query_counts else 0,
+    }
+
+
+def run_test_client(app, scenario, route, count, users):
+    """ Sends count requests to a route one after the other through Flask's test client """
+    # Logging in hashes a password, so it happens before the clock starts
+    clients = {user_id: login(app.test_client(), route, user_id) for user_id in range(2, 2 + min(users, count))}
+    latencies, query_counts, errors = [], [], 0
+    start = time.perf_counter()
+
+    for i in range(count):
+        user_id = 2 + i % users
+        method, path, data, files = scenario.request(route, user_id)
+        if files:
+            data = {**data, **{name: (io.BytesIO(content), filename) for name, (filename, content) in files.items()}}
+
+        began = time.perf_counter()
+        response = clients[user_id].open(path, method=method, data=data)
+        latencies.append(time.perf_counter() - began)
+        query_counts.append(queries(response.headers))
+        if response.status_code >= 400:
+            errors += 1
+
+    return summarize(route, latencies, query_counts, errors, time.perf_counter() - start)
+
+
+def run_server(base, scenario, route, count, users, concurrency):
+    """ Sends count requests to a route from concurrency threads through a real WSGI server """
+    latencies, query_counts, errors = [], [], []
+
+    # A session per thread and user, as requests.Session is not thread-safe, logged in before the clock starts
+    sessions = [{} for _ in range(concurrency)]
+    for i in range(count):
+        user_id = 2 + i % users
+        if user_id not in sessions[i % concurrency]:
+            sessions[i % concurrency][user_id] = login(requests.Session(), route, user_id, base)
+
+    def worker(index):
+        for i in range(index, count, concurrency):
+            user_id = 2 + i % users
+            method, path, data, files = scenario.request(route, user_id)
+
+            began = time.perf_counter()
+            response = sessions[index][user_id].request(method, base + path, data=data, files=files,
+                                                        allow_redirects=False)
+            latencies.append(time.perf_counter() - began)
+            query_counts.append(queries(response.headers))
+            if response.status_code >= 400:
+                errors.append(response.status_code)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return summarize(route, latencies, query_counts, len(errors), time.perf_counter() - start)
+
+
+def login(client, route, user_id, base=""):
+    """ Logs a client in as the admin or as a client, depending on who uses the route """
+    if route == "login":
+        return client
+    username = "admin" if route in ("index", "view_details") else f"client{user_id - 2}"
+    client.post(f"{base}/login", data={"username": username, "password": PASSWORD})
+    return client
+
+
+def compare(results, baseline, tolerance):
+    """ Prints how the results moved against a baseline, returns the regressions """
+    regressions = []
+    print(f"\n{'compared with baseline':<34}{'p50':>10}{'p95':>10}{'queries':>10}")
+    for key, result in results.items():
+        before = baseline.get(key)
+        if not before:
+            print(f"{key:<34}{'new':>10}")
+            continue
+
+        changes = {}
+        for metric in ("p50", "p95", "queries"):
+            changes[metric] = (result[metric] - before[metric]) / before[metric] if before[metric] else 0
+        print(f"{key:<34}" + "".join(f"{changes[metric]:>+10.0%}" for metric in ("p50", "p95", "queries")))
+
+        for metric in ("p95", "queries"):
+            if changes[metric] > tolerance:
+                regressions.append(f"{key} {metric}: {before[metric]:.1f} -> {result[metric]:.1f}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=20, help="client accounts seeded")
+    parser.add_argument("--orders", type=int, default=5000, help="orders seeded")
+    parser.add_argument("--files", type=int, default=200, help="distinct reference images seeded")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the synthetic data and requests")
+    parser.add_argument("--requests", type=int, default=100, help="requests per route and mode")
+    parser.add_argument("--concurrency", type=int, default=4, help="client threads against the WSGI server")
+    parser.add_argument("--mode", default="both", choices=["client", "server", "both"])
+    parser.add_argument("--routes", default=",".join(ROUTES), help="comma separated routes to run")
+    parser.add_argument("--baseline", help="JSON results of an earlier run to compare with")
+    parser.add_argument("--save-baseline", help="where to write the results as a new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="largest slowdown accepted against the baseline")
+    arguments = parser.parse_args()
+
+    routes = [route for route in arguments.routes.split(",") if route]
+    for route in routes:
+        if route not in ROUTES:
+            parser.error(f"unknown route: {route}")
+
+    directory = tempfile.mkdtemp(prefix="orders-benchmark-")
+    owners = seed_database(directory, arguments.users, arguments.orders, arguments.files, arguments.seed)
+
+    # Uploads are written to the scratch directory, the profiler reports the queries of every request,
+    # and every client logs in from the same address
+    os.chdir(directory)
+    sys.path.insert(0, ROOT)
+    from app import create_app
+    app = create_app({"DATABASE_URL": f"sqlite:///{os.path.join(directory, 'orders.db')}", "PROFILE": True,
+                      "RATE_LIMIT": False})
+
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    modes = ["client", "server"] if arguments.mode == "both" else [arguments.mode]
+    scenario = Scenario(owners, arguments.seed)
+    results = {}
+
+    if "server" in modes:
+        server = make_server("127.0.0.1", 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+
+    print(f"{arguments.orders} orders, {arguments.users} users, {arguments.files} files, "
+          f"{arguments.requests} requests per route, seed {arguments.seed}\n")
+    print(f"{'route':<34}{'req/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>10}{'errors':>8}")
+    for mode in modes:
+        for route in routes:
+            if mode == "client":
+                result = run_test_client(app, scenario, route, arguments.requests, arguments.users)
+            else:
+                result = run_server(base, scenario, route, arguments.requests, arguments.users, arguments.concurrency)
+            key = f"{mode}:{route}"
+            results[key] = result
+            print(f"{key:<34}{result['throughput']:>10.1f}{result['p50']:>10.1f}{result['p95']:>10.1f}"
+                  f"{result['p99']:>10.1f}{result['queries']:>10.1f}{result['errors']:>8}")
+
+    if "server" in modes:
+        server.shutdown()
+
+    if arguments.save_baseline:
+        with open(os.path.join(ROOT, arguments.save_baseline), "w") as file:
+            json.dump(results, file, indent=2)
+
+    if arguments.baseline:
+        with open(os.path.join(ROOT, arguments.baseline)) as file:
+            regressions = compare(results, json.load(file), arguments.tolerance)
+        if regressions:
+            print("\nRegressions:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
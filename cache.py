@@ -0,0 +1,50 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ A thread-safe, size-bounded LRU cache whose entries expire ttl seconds after being stored """
+
+    def __init__(self, maxsize=1024, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """ Returns the cached value of key, or default if it is missing or expired """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+
+            # Mark the entry as the most recently used
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        """ Stores value under key, evicting the least recently used entry if the cache is full """
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        """ Removes key from the cache if it is there """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Removes every entry """
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import re
+import threading
+from datetime import datetime, timezone
+
+from flask import current_app, make_response, request, session, url_for
+from werkzeug.http import is_resource_modified
+
+from thumbnails import thumbnail
+
+# Files whose URL changes with their content are cached by browsers for a year without asking again
+IMMUTABLE = "public, max-age=31536000, immutable"
+
+# Pages that must never be kept by the browser or a proxy, such as the ones handling passwords
+NO_STORE_ENDPOINTS = {"views.login", "views.register", "views.logout"}
+
+# Uploaded references (and their thumbnails) are stored under the SHA-256 of their content, see uploads.py
+CONTENT_ADDRESSED = re.compile(r"uploads/(.+/)?[0-9a-f]{64}\.\w+")
+
+# Fingerprints of static files by path, recomputed when a file is modified
+_fingerprints = {}
+_lock = threading.Lock()
+
+
+def fingerprint(filename):
+    """ Returns a short hash of the content of a static file, or None if it does not exist """
+    path = os.path.join(current_app.static_folder, filename)
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+
+    with _lock:
+        cached = _fingerprints.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    with open(path, "rb") as file:
+        digest = hashlib.sha256(file.read()).hexdigest()[:12]
+    with _lock:
+        _fingerprints[path] = (mtime, digest)
+    return digest
+
+
+def static_url(filename):
+    """ Returns the URL of a static file with its fingerprint, so it can be cached until it changes """
+    version = fingerprint(filename)
+    if version is None:
+        return url_for("static", filename=filename)
+    return url_for("static", filename=filename, v=version)
+
+
+def apply_cache_policy(response):
+    """
+    Sets the Cache-Control header of a response unless the view already did.
+
+    Fingerprinted static files and uploads are immutable, other static files are revalidated
+    with the ETag Flask sends for them, pages are private to the user and revalidated on every visit,
+    and the login pages and static files that could not be served are not stored at all.
+    """
+    if request.endpoint in NO_STORE_ENDPOINTS:
+        response.headers["Cache-Control"] = "no-store"
+        return response
+
+    if request.endpoint == "static":
+        if response.status_code not in (200, 304):
+            # A thumbnail that is missing now exists a moment later under the same URL
+            response.headers["Cache-Control"] = "no-store"
+            return response
+        filename = request.view_args.get("filename", "")
+        if CONTENT_ADDRESSED.fullmatch(filename) or (
+                request.args.get("v") and request.args.get("v") == fingerprint(filename)):
+            response.headers["Cache-Control"] = IMMUTABLE
+        return response
+
+    if "Cache-Control" not in response.headers:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def order_response(order, render, *variant, references=()):
+    """
+    Returns the page of an order rendered by render(), or 304 Not Modified if the browser already has it.
+
+    The ETag comes from the order's version, which every write to the order changes, from
+    variant, whatever else the page depends on (such as who is looking at it), and from which
+    thumbnails of the references shown exist yet, since writing them does not change the version.
+    """
+    thumbnails = tuple((thumbnail(reference["file_path"]), thumbnail(reference["file_path"], "webp"))
+                       for reference in references if reference["status"] == "ready")
+    etag = hashlib.sha256(repr((order["order_id"], order["version"], variant, thumbnails)).encode()).hexdigest()[:32]
+    last_modified = datetime.strptime(order["updated_at"], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+
+    # A flashed message is shown once, so the page must be rendered to show it
+    if "_flashes" not in session and not is_resource_modified(request.environ, etag=etag,
+                                                               last_modified=last_modified):
+        response = make_response("", 304)
+    else:
+        response = make_response(render())
+
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
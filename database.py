@@ -0,0 +1,270 @@
+import os
+import queue
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, urlsplit
+
+# Pragmas set on every new SQLite connection, they can be overridden in the query string of the URL.
+# WAL lets readers carry on while an order is being written, and NORMAL is still durable in WAL mode.
+SQLITE_PRAGMAS = {
+    "journal_mode": "wal",
+    "synchronous": "normal",
+    "busy_timeout": "5000",
+    "cache_size": "-16000",
+    "temp_store": "memory",
+    "foreign_keys": "on",
+}
+
+
+def dict_factory(cursor, row):
+    """ Returns rows as dicts, like the CS50 library does """
+    return {column[0]: value for column, value in zip(cursor.description, row)}
+
+
+class SQLite:
+    """
+    A SQLite database with a thread-safe pool of connections.
+
+    execute() keeps the call style of the CS50 library: SELECTs return a list of dicts,
+    INSERTs the new primary key, UPDATEs and DELETEs the number of rows they matched,
+    and constraint violations raise ValueError.
+    """
+
+    def __init__(self, path, pool_size=8, pool_timeout=30, cached_statements=256, **pragmas):
+        self.path = path
+        self.pool_size = int(pool_size)
+        self.pool_timeout = float(pool_timeout)
+        self.cached_statements = int(cached_statements)
+        self.pragmas = {**SQLITE_PRAGMAS, **pragmas}
+
+        self._pool = queue.LifoQueue()
+        self._created = 0
+        self._lock = threading.Lock()
+        # The connection a thread holds on to between BEGIN and COMMIT
+        self._local = threading.local()
+        # Called with the SQL and duration in seconds of every statement, see profiling.py
+        self.listeners = []
+
+    def _connect(self):
+        """ Opens a new connection with the pragmas applied """
+        # Like the CS50 library, refuse to create a new database by accident
+        if not os.path.isfile(self.path):
+            raise RuntimeError(f"does not exist: {self.path}")
+
+        # Autocommit unless a transaction is started explicitly, statements are prepared once per connection
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False,
+                                     cached_statements=self.cached_statements)
+        connection.row_factory = dict_factory
+        for name, value in self.pragmas.items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        return connection
+
+    def _acquire(self):
+        """ Takes a connection from the pool, opening a new one while the pool is not full """
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.pool_size:
+                self._created += 1
+                try:
+                    return self._connect()
+                except Exception:
+                    self._created -= 1
+                    raise
+
+        try:
+            return self._pool.get(timeout=self.pool_timeout)
+        except queue.Empty:
+            raise RuntimeError("timed out waiting for a database connection")
+
+    def _release(self, connection):
+        """ Returns a connection to the pool """
+        self._pool.put(connection)
+
+    @contextmanager
+    def _connection(self):
+        """ Yields the connection of this thread's transaction, or one borrowed from the pool """
+        connection = getattr(self._local, "connection", None) or self._acquire()
+        try:
+            yield connection
+        except sqlite3.IntegrityError as e:
+            raise ValueError(e) from None
+        except (sqlite3.OperationalError, sqlite3.ProgrammingError) as e:
+            raise RuntimeError(e) from None
+        finally:
+            if connection.in_transaction:
+                # BEGIN was executed, the following statements of this thread use the same connection until COMMIT
+                self._local.connection = connection
+            else:
+                self._local.connection = None
+                self._release(connection)
+
+    def execute(self, sql, *args):
+        """ Executes one SQL statement with positional ? placeholders """
+        match = re.match(r"\s*(\w+)", sql)
+        command = match.group(1).upper() if match else ""
+
+        start = time.perf_counter()
+        try:
+            with self._connection() as connection:
+                cursor = connection.execute(sql, args)
+
+                if command == "INSERT":
+                    return cursor.lastrowid if cursor.rowcount == 1 else None
+                elif command in ("UPDATE", "DELETE"):
+                    return cursor.rowcount
+                elif cursor.description is not None:
+                    return cursor.fetchall()
+                return True
+        finally:
+            self._notify(sql, start)
+
+    def executemany(self, sql, rows):
+        """ Executes one statement once for every tuple of arguments in rows, returns the number of rows changed """
+        start = time.perf_counter()
+        try:
+            with self._connection() as connection:
+                return connection.executemany(sql, rows).rowcount
+        finally:
+            self._notify(sql, start)
+
+    def iterate(self, sql, *args, size=1000):
+        """
+        Yields the rows of a SELECT one at a time, fetching size rows at once from the cursor,
+        so memory use does not grow with the result. The connection is held until the rows run out.
+        """
+        start = time.perf_counter()
+        try:
+            with self._connection() as connection:
+                cursor = connection.execute(sql, args)
+                try:
+                    while True:
+                        rows = cursor.fetchmany(size)
+                        if not rows:
+                            return
+                        yield from rows
+                finally:
+                    cursor.close()
+        finally:
+            self._notify(sql, start)
+
+    def _notify(self, sql, start):
+        """ Tells the listeners how long a statement took """
+        if self.listeners:
+            seconds = time.perf_counter() - start
+            for listener in self.listeners:
+                listener(sql, seconds)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Runs the statements of the with block in a single transaction.
+
+        It is committed when the block ends and rolled back if the block raises.
+        The write lock is taken up front, so concurrent writers wait for each other
+        instead of failing when they upgrade from reading to writing.
+        """
+        # Statements of a nested block simply join the outer transaction
+        if getattr(self._local, "connection", None) is not None:
+            yield self
+            return
+
+        self.execute("BEGIN IMMEDIATE")
+        self._local.callbacks = []
+        try:
+            yield self
+        except BaseException:
+            self._local.callbacks = None
+            self.execute("ROLLBACK")
+            raise
+        try:
+            self.execute("COMMIT")
+        finally:
+            callbacks, self._local.callbacks = self._local.callbacks, None
+        for callback in callbacks:
+            callback()
+
+    def on_commit(self, callback):
+        """ Calls callback once the transaction() block of this thread is committed, or right away outside of one """
+        callbacks = getattr(self._local, "callbacks", None)
+        if callbacks is None:
+            callback()
+        else:
+            callbacks.append(callback)
+
+    def close(self):
+        """ Closes every idle connection of the pool """
+        while True:
+            try:
+                connection = self._pool.get_nowait()
+            except queue.Empty:
+                break
+            connection.close()
+            with self._lock:
+                self._created -= 1
+
+
+# Database back ends by URL scheme
+BACKENDS = {
+    "sqlite": SQLite,
+}
+
+
+def connect(url):
+    """
+    Returns a database for a URL such as sqlite:///orders.db.
+
+    Options in the query string are passed to the back end,
+    e.g. sqlite:///orders.db?pool_size=4&journal_mode=delete
+    """
+    parts = urlsplit(url)
+    if parts.scheme not in BACKENDS:
+        raise RuntimeError(f"unsupported database: {parts.scheme}")
+
+    # sqlite:///orders.db is relative, sqlite:////tmp/orders.db is absolute
+    path = parts.path[1:] if parts.path.startswith("/") else parts.path
+    return BACKENDS[parts.scheme](path, **dict(parse_qsl(parts.query)))
+
+
+class Database:
+    """
+    The database handle every module shares.
+
+    The back end is only created from the URL when a statement first runs, so importing a module
+    costs nothing and create_app() can still choose which database the handle points to.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self._backend = None
+        self._lock = threading.Lock()
+
+    def configure(self, url):
+        """ Points the handle to another database, which is only possible before it is first used """
+        with self._lock:
+            if self._backend is not None and url != self.url:
+                raise RuntimeError(f"already connected to {self.url}")
+            self.url = url
+
+    @property
+    def backend(self):
+        """ The back end of the URL, created on first use """
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = connect(self.url)
+        return self._backend
+
+    def __getattr__(self, name):
+        # execute(), transaction(), listeners and the rest come from the back end
+        return getattr(self.backend, name)
+
+
+# The database shared by every module, DATABASE_URL unless create_app() is given another one
+db = Database(os.environ.get("DATABASE_URL", "sqlite:///orders.db"))
@@ -0,0 +1,35 @@
+from flask import render_template
+from markupsafe import Markup
+
+from cache import TTLCache
+
+# Rendered table rows by (order_id, is_admin, action_required), with the version of the order they show.
+# A row looks the same for everyone with the same role on the same page, so it is rendered once for all of them.
+rows = TTLCache(maxsize=8192, ttl=24 * 60 * 60)
+
+
+def render_rows(orders, is_admin, action_required):
+    """
+    Adds the rendered table row of every order as order["row"].
+
+    Only the orders whose version changed since they were last rendered go through the template again.
+    """
+    for order in orders:
+        key = (order["order_id"], is_admin, action_required)
+        cached = rows.get(key)
+        if cached and cached[0] == order["version"]:
+            order["row"] = cached[1]
+            continue
+
+        order["row"] = Markup(render_template("order-row.html", order=order, is_admin=is_admin,
+                                              action_required=action_required))
+        rows.set(key, (order["version"], order["row"]))
+
+    return orders
+
+
+def forget_order(order_id):
+    """ Drops the cached rows of a deleted order """
+    for is_admin in (True, False):
+        for action_required in (True, False):
+            rows.delete((order_id, is_admin, action_required))
@@ -1,16 +1,32 @@
 import re
 import os
-from flask import redirect, render_template, session, request
+import json
+from flask import g, redirect, render_template, session, request
 from functools import wraps
 from werkzeug.utils import secure_filename
-from cs50 import SQL
-from datetime import datetime
 
-# Configure CS50 Library to use SQLite database
-db = SQL("sqlite:///orders.db")
+from database import db
+from uploads import receive_upload
+from validation import validate_order
 
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg'}
 
+# An order with its owner, palette and references, the lists are aggregated into JSON arrays
+ORDER_DETAILS_QUERY = """
+    SELECT orders.*,
+    users.username,
+    users.email,
+    (SELECT json_group_array(DISTINCT color_hex)
+     FROM color_palette WHERE order_id = orders.order_id) AS colors,
+    (SELECT json_group_array(json_object('file_path', file_path, 'status', status))
+     FROM character_references WHERE order_id = orders.order_id) AS character_references,
+    (SELECT json_group_array(json_object('file_path', file_path, 'status', status))
+     FROM background_references WHERE order_id = orders.order_id) AS background_references
+    FROM orders
+    JOIN users ON users.id = orders.user_id
+    WHERE orders.order_id = ?
+    """
+
 
 def apology(message, is_admin=False, code=400):
     """Render message as an apology to user."""
@@ -48,6 +64,12 @@ def login_required(f):
     def decorated_function(*args, **kwargs):
         if session.get("user_id") is None:
             return redirect("/login")
+
+        # Resolve the user once, the view reads it from g.identity
+        if get_identity(session["user_id"]) is None:
+            # The account no longer exists
+            session.clear()
+            return redirect("/login")
         return f(*args, **kwargs)
 
     return decorated_function
@@ -64,7 +86,11 @@ def allowed_file(filename):
 
 
 def process_files(file_key, upload_folder):
-    file_paths = []
+    """
+    Receives the submitted references, returns a dict of the path each one will be stored at
+    to the temporary file holding it. The files are stored by the ingest worker once the order is saved.
+    """
+    received = {}
     # If a reference was submitted
     if file_key in request.files:
         # Retrieve all files in a list
@@ -72,20 +98,22 @@ def process_files(file_key, upload_folder):
 
         for file in files:
             if file and allowed_file(file.filename):
-                # Secure filename
-                filename = secure_filename(file.filename)
-                # Make sure filename is unique
-                unique_filename = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-                # Save the file in the file path
-                file_path = os.path.join(upload_folder, unique_filename)
-                file.save(file_path)
-                # Store the file path
-                file_paths.append(file_path)
-    return file_paths
+                # Files are stored under the hash of their content, so identical files are saved once
+                extension = secure_filename(file.filename).rsplit('.', 1)[1].lower()
+                file_path, source = receive_upload(file, upload_folder, extension)
+                # Keep the path once even if the same image was attached twice
+                if file_path in received:
+                    os.remove(source)
+                else:
+                    received[file_path] = source
+
+    return received
 
 
 def usd(value):
-    """Format value as USD."""
+    """Format value as USD, or '-' if there is no price yet."""
+    if value is None or value == '-':
+        return '-'
     return f"${value:,.2f}"
 
 
@@ -113,7 +141,7 @@ def is_valid_order_id(is_admin, order_id):
                 return False
 
         else:
-            order = db.execute("SELECT * FROM orders WHERE order_id = ?", order_id)
+            order = db.execute("SELECT order_id FROM orders WHERE order_id = ?", order_id)
             if len(order) == 0:
                 return False
 
@@ -123,111 +151,73 @@ def is_valid_order_id(is_admin, order_id):
     return True
 
 
-def get_form_data():
-    """ Get and validate data from an order form """
+def load_order(order_id, user_id=None):
+    """
+    Loads an order with its owner, color palette and references in a single query.
 
-    # Extract data from the form
-    order_name = request.form.get("order_name")
-    character_part = request.form.get("character_part")
-    character_part_options = ["Head", "Half Body", "Full Body"]
-    preferred_style = request.form.get("preferred_style")
-    preferred_style_options = ["Chibi", "Normal"]
-    pose_view = request.form.get("pose_view")
-    pose_view_options = ["Front View", "3/4 View", "Side View"]
-    pose_description = request.form.get("pose_description")
-    character_features_description = request.form.get("character_features_description")
-    outfit_description = request.form.get("outfit_description")
-    background_preference = request.form.get("background")
-    background_options = ["with-background", "without-background"]
-    background_description = request.form.get("background_description")
-    due_date = request.form.get("due_date")
-    colors = request.form.getlist("colors[]")
-
-    # Check for errors
-    # Error 1: leaving any field blank
-    if not order_name:
-        return apology("must provide order name")
-    if not character_part:
-        return apology("must provide character part")
-    if not preferred_style:
-        return apology("must provide preferred style")
-    if not pose_view:
-        return apology("must provide pose view")
-    if not pose_description:
-        return apology("must provide pose description")
-    if not character_features_description:
-        return apology("must provide character features description")
-    if not outfit_description:
-        return apology("must provide outfit description")
-
-     # If user inserted invalid colors
-    for color in colors:
-        if not is_valid_color(color):
-            return apology("invalid color(s)")
-
-    # If user did not choose a color pallet
-    if len(set(colors)) < 2:
-        return apology("must provide at least two different colors")
-
-    if not background_preference:
-        return apology("must select background preference")
-    if background_preference == "with-background" and not background_description:
-        return apology("must provide background description")
-    if not due_date:
-        return apology("must provide due date")
-
-    # Error 2: drop down menues and radio buttons were submitted incorrectly
-    if character_part not in character_part_options:
-        return apology("invalid character part")
-    if preferred_style not in preferred_style_options:
-        return apology("invalid preferred style")
-    if pose_view not in pose_view_options:
-        return apology("invalid pose view")
-    if background_preference not in background_options:
-        return apology("invalid background preference")
-
-    # Error 3: Date is in the past
-    # Parse the provided date and get the current date
+    If user_id is given, the order must also belong to that user.
+    Returns None if the order_id is invalid or no such order exists.
+    """
     try:
-        due_date_obj = datetime.strptime(due_date, "%Y-%m-%d")
-        today = datetime.now()
-    except ValueError:
-        return apology("invalid due date")
-
-    # Check if the due date is in the past
-    if due_date_obj < today:
-        return apology("due date is in the past")
-
-    if background_preference == "with-background":
-        has_background = 'TRUE'
-    else:
-        has_background = 'FALSE'
-        background_description = None
-
-    return {
-        "order_name": order_name,
-        "character_part": character_part,
-        "preferred_style": preferred_style,
-        "pose_view": pose_view,
-        "pose_description": pose_description,
-        "character_features_description": character_features_description,
-        "outfit_description": outfit_description,
-        "has_background": has_background,
-        "background_description": background_description,
-        "due_date": due_date,
-        "colors": colors,
+        order_id = int(order_id)
+    except (TypeError, ValueError):
+        return None
+
+    query = ORDER_DETAILS_QUERY
+    arguments = [order_id]
+    if user_id is not None:
+        query += " AND orders.user_id = ?"
+        arguments.append(user_id)
+
+    rows = db.execute(query, *arguments)
+
+    # Count the round trips of this request, they are reported in the X-Order-Queries header
+    g.order_queries = g.get("order_queries", 0) + 1
+
+    if len(rows) == 0:
+        return None
+    order = rows[0]
+
+    details = {
+        "user_info": {"username": order.pop("username"), "email": order.pop("email")},
+        "colors": [{"color_hex": color} for color in json.loads(order.pop("colors"))],
+        "character_references": json.loads(order.pop("character_references")),
+        "background_references": json.loads(order.pop("background_references")),
     }
+    order["has_background"] = order["has_background"] == 'TRUE'
+    details["order"] = order
 
+    return details
+
+
+def get_form_data():
+    """ Get and validate data from an order form """
+    form_data, errors = validate_order(request.form, request.form.getlist("colors[]"))
+    if errors:
+        return apology("; ".join(errors))
+    return form_data
+
+
+def get_identity(user_id):
+    """
+    Returns the id, username and role of a user, or None if the user does not exist.
+
+    The identity is resolved with one primary key lookup per request. It is not kept across requests,
+    so a role changed by another process (such as `flask set-admin`) applies to the next request.
+    """
+    identity = g.get("identity")
+    if identity and identity["id"] == user_id:
+        return identity
 
-def user_or_admin(user_id):
-    """ Returns True if user is an admin, False otherwise """
+    rows = db.execute("SELECT id, username, is_admin FROM users WHERE id = ?", user_id)
+    if len(rows) == 0:
+        return None
+    identity = {"id": rows[0]["id"], "username": rows[0]["username"], "is_admin": bool(rows[0]["is_admin"])}
 
-    is_admin = db.execute("SELECT is_admin FROM users WHERE id = ?", user_id)
-    is_admin = is_admin[0]["is_admin"]
-    return is_admin
+    g.identity = identity
+    return identity
 
 
-def is_valid_color(color):
-    """ Validate if the input is a valid hex color code. """
-    color_regex = r'^#[0-9A-Fa-f]{6}$'
-    return bool(re.match(color_regex, color))
+def set_admin(user_id, is_admin):
+    """ Grants or revokes the admin role of a user, which applies from their next request """
+    db.execute("UPDATE users SET is_admin = ? WHERE id = ?", is_admin, user_id)
@@ -0,0 +1,96 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from database import db
+from thumbnails import worker as thumbnail_worker
+from uploads import persist_upload
+
+# Tables of references whose files are stored in the background
+REFERENCE_TABLES = ("character_references", "background_references")
+
+# Received files are moved into place and synced to disk by this many threads, so several
+# files of an order are stored at once and the requests never wait for them
+WORKERS = 4
+
+logger = logging.getLogger(__name__)
+
+
+def mark_references(table, path, status):
+    """ Sets the status of the pending references to a file, in every order that has it """
+    if table not in REFERENCE_TABLES:
+        raise ValueError(f"not a reference table: {table}")
+    db.execute(f"UPDATE {table} SET status = ? WHERE file_path = ? AND status = 'pending'", status, path)
+
+
+class IngestWorker:
+    """ Stores the files of references saved as pending, then marks them ready (or failed) """
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.pending = 0
+        self._done = threading.Condition()
+        self._lock = threading.Lock()
+        self._pool = None
+
+    def enqueue(self, table, uploads):
+        """ Schedules the received files of a dict of content path -> temporary path """
+        uploads = {path: source for path, source in uploads.items() if source is not None}
+        if not uploads:
+            return
+
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix="ingest")
+        with self._done:
+            self.pending += len(uploads)
+        for path, source in uploads.items():
+            self._pool.submit(self._store, table, path, source)
+
+    def _store(self, table, path, source):
+        try:
+            persist_upload(source, path)
+        except Exception:
+            logger.exception("Could not store %s", path)
+            try:
+                os.remove(source)
+            except OSError:
+                pass
+            status = "failed"
+        else:
+            status = "ready"
+
+        try:
+            mark_references(table, path, status)
+            if status == "ready":
+                # Resize the new image in the background, the pages show the original until then
+                thumbnail_worker.enqueue([path])
+        except Exception:
+            logger.exception("Could not mark %s %s", path, status)
+        finally:
+            with self._done:
+                self.pending -= 1
+                self._done.notify_all()
+
+    def wait(self):
+        """ Blocks until every queued file has been stored """
+        with self._done:
+            self._done.wait_for(lambda: self.pending == 0)
+
+
+worker = IngestWorker()
+
+
+def resolve_pending():
+    """
+    Settles the references left pending by a stop of the app before their files were stored:
+    ready if the file is there after all, failed otherwise. Returns how many of each.
+    """
+    report = {"ready": 0, "failed": 0}
+    for table in REFERENCE_TABLES:
+        for row in db.execute(f"SELECT DISTINCT file_path FROM {table} WHERE status = 'pending'"):
+            status = "ready" if os.path.exists(row["file_path"]) else "failed"
+            mark_references(table, row["file_path"], status)
+            report[status] += 1
+    return report
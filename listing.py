@@ -0,0 +1,147 @@
+import base64
+import binascii
+from datetime import datetime
+
+from database import db
+
+# Number of orders shown per page and the largest page a client may request
+PAGE_SIZE = 25
+MAX_PAGE_SIZE = 100
+
+STATUSES = ("pending", "reviewed", "accepted", "completed")
+
+# Columns of an order shown in a row of the listing, see order-row.html
+ROW_COLUMNS = """order_id,
+            version,
+            order_name,
+            price,
+            price_display,
+            status,
+            status_label,
+            status_class,
+            order_due_date,
+            created_at"""
+
+# One order of the listing, for the dashboards updated live, see live.py
+ROW_QUERY = f"SELECT {ROW_COLUMNS} FROM orders WHERE order_id = ?"
+
+
+def encode_cursor(order):
+    """ Turns the last order of a page into an opaque cursor for the next page """
+    raw = f"{order['order_due_date']}|{order['order_id']}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """ Returns the (order_due_date, order_id) pair stored in a cursor, or None if it is invalid """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        due_date, order_id = raw.rsplit("|", 1)
+        datetime.strptime(due_date, "%Y-%m-%d")
+        return due_date, int(order_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def parse_filters(args, is_admin):
+    """ Validates the listing filters in the query string, returns None if any of them is invalid """
+    filters = {
+        "status": args.get("status") or None,
+        "due_from": args.get("due_from") or None,
+        "due_to": args.get("due_to") or None,
+        "user_id": None,
+        "after": None,
+        "limit": PAGE_SIZE,
+    }
+
+    if filters["status"] and filters["status"] not in STATUSES:
+        return None
+
+    for key in ("due_from", "due_to"):
+        if filters[key]:
+            try:
+                datetime.strptime(filters[key], "%Y-%m-%d")
+            except ValueError:
+                return None
+
+    # Only admins may look at the orders of a specific user
+    if is_admin and args.get("user_id"):
+        try:
+            filters["user_id"] = int(args.get("user_id"))
+        except ValueError:
+            return None
+
+    if args.get("after"):
+        filters["after"] = decode_cursor(args.get("after"))
+        if not filters["after"]:
+            return None
+
+    if args.get("limit"):
+        try:
+            filters["limit"] = int(args.get("limit"))
+        except ValueError:
+            return None
+        # Clamp the page size instead of refusing the request
+        filters["limit"] = max(1, min(filters["limit"], MAX_PAGE_SIZE))
+
+    return filters
+
+
+def listing_query(user_id=None, status=None, due_from=None, due_to=None, after=None, limit=PAGE_SIZE):
+    """ Builds the SQL and arguments for one page of the order listing """
+    conditions = []
+    arguments = []
+
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        arguments.append(user_id)
+    if status:
+        conditions.append("status = ?")
+        arguments.append(status)
+    if due_from:
+        conditions.append("order_due_date >= ?")
+        arguments.append(due_from)
+    if due_to:
+        conditions.append("order_due_date <= ?")
+        arguments.append(due_to)
+    if after:
+        conditions.append("(order_due_date, order_id) > (?, ?)")
+        arguments.extend(after)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+    # Fetch one extra row to know whether there is a next page
+    query = f"""
+            SELECT {ROW_COLUMNS}
+            FROM orders
+            {where}
+            ORDER BY order_due_date ASC, order_id ASC
+            LIMIT ?
+            """
+    arguments.append(limit + 1)
+
+    return query, arguments
+
+
+def list_orders(user_id=None, status=None, due_from=None, due_to=None, after=None, limit=PAGE_SIZE):
+    """
+    Returns one page of orders sorted by (order_due_date, order_id) and the cursor of the next page.
+
+    The page is found by seeking past the cursor instead of using OFFSET,
+    so every page costs the same no matter how deep into the list it is.
+    """
+    query, arguments = listing_query(user_id, status, due_from, due_to, after, limit)
+    orders = db.execute(query, *arguments)
+
+    next_cursor = None
+    if len(orders) > limit:
+        orders = orders[:limit]
+        next_cursor = encode_cursor(orders[-1])
+
+    return orders, next_cursor
+
+
+def load_row(order_id):
+    """ Returns the listing row of one order, or None if it no longer exists """
+    rows = db.execute(ROW_QUERY, order_id)
+    return rows[0] if rows else None
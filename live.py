@@ -0,0 +1,121 @@
+import json
+import queue
+import threading
+import time
+
+# Events a subscriber may fall behind by, past that its page is told to reload instead
+MAX_PENDING = 64
+
+# Seconds between two heartbeats of an idle stream, they keep proxies from closing it and notice clients that left
+HEARTBEAT = 15
+
+# Seconds a stream lasts, the browser then reconnects on its own, which checks the login again
+STREAM_SECONDS = 30 * 60
+
+# How long the browser waits before reconnecting, in milliseconds
+RETRY = 5000
+
+
+class Subscription:
+    """ The events waiting to be sent to one open dashboard """
+
+    def __init__(self, user_id, is_admin, max_pending=MAX_PENDING):
+        self.user_id = user_id
+        self.is_admin = is_admin
+        self.events = queue.Queue(max_pending)
+        # Set once an event was dropped because the queue was full
+        self.lagging = False
+
+    def put(self, event):
+        """ Queues an event without waiting, a full queue marks the subscription lagging """
+        try:
+            self.events.put_nowait(event)
+        except queue.Full:
+            self.lagging = True
+
+    def get(self, timeout):
+        """ Returns the next event, or None if there was none within timeout seconds """
+        try:
+            return self.events.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broker:
+    """
+    Hands the changes to orders over to the dashboards open in this process.
+
+    An event goes to the subscriptions of the order's owner and of every admin, so publishing
+    costs the number of interested dashboards, not the number of open ones.
+    Publishing never blocks: a dashboard that falls behind is told to reload.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING):
+        self.max_pending = max_pending
+        self._admins = set()
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, user_id, is_admin):
+        """ Returns a new subscription to the orders a user can see """
+        subscription = Subscription(user_id, is_admin, self.max_pending)
+        with self._lock:
+            if is_admin:
+                self._admins.add(subscription)
+            else:
+                self._users.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """ Stops sending events to a subscription """
+        with self._lock:
+            if subscription.is_admin:
+                self._admins.discard(subscription)
+            else:
+                subscriptions = self._users.get(subscription.user_id, set())
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    self._users.pop(subscription.user_id, None)
+
+    def publish(self, event, user_id):
+        """ Sends an event about an order of user_id to its owner and the admins """
+        with self._lock:
+            subscriptions = list(self._admins) + list(self._users.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(event)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._admins) + sum(len(subscriptions) for subscriptions in self._users.values())
+
+
+def format_event(name, data):
+    """ Formats one server-sent event """
+    return f"event: {name}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream(broker, user_id, is_admin, render, heartbeat=HEARTBEAT, seconds=STREAM_SECONDS):
+    """
+    Yields the events of a user's dashboard as server-sent events, each one passed through render() first.
+
+    The subscription is made when the stream starts and dropped when the client goes away.
+    """
+    subscription = broker.subscribe(user_id, is_admin)
+    try:
+        yield f"retry: {RETRY}\n\n"
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            event = subscription.get(heartbeat)
+            if subscription.lagging:
+                yield format_event("reload", {})
+                return
+            if event is None:
+                yield ": heartbeat\n\n"
+            else:
+                yield format_event("order", render(event))
+    finally:
+        broker.unsubscribe(subscription)
+
+
+# The broker shared by the write paths and the event streams of this process
+broker = Broker()
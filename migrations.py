@@ -0,0 +1,353 @@
+from helpers import ORDER_DETAILS_QUERY
+from listing import ROW_QUERY, STATUSES, listing_query
+from scheduler import EVENTS_QUERY, UNDELIVERED_QUERY, WINDOW_QUERY
+from search import SEARCH_QUERY
+
+# The display fields of an order, computed by triggers whenever it is written.
+# The price is formatted like helpers.usd(), through whole cents since printf only groups thousands of integers.
+DISPLAY_FIELDS = """
+    price_display = CASE WHEN price IS NULL THEN '-' ELSE printf('$%,d.%02d',
+        CAST(round(price * 100) AS INTEGER) / 100, CAST(round(price * 100) AS INTEGER) % 100) END,
+    status_label = upper(substr(status, 1, 1)) || substr(status, 2),
+    status_class = CASE status
+        WHEN 'pending' THEN 'color-grey bold'
+        WHEN 'reviewed' THEN 'bold'
+        ELSE 'color-green bold'
+    END
+    """
+
+# Every schema change made after orders.sql, in the order they must be applied.
+# The version of a database is stored in PRAGMA user_version, so each migration runs once.
+MIGRATIONS = [
+    (1, "Index the order listing, ownership checks and order references", [
+        # order_id is the rowid of orders, it is already unique and indexed
+        "DROP INDEX IF EXISTS order_id",
+        # order_id is implicitly the last column of every index on orders
+        "CREATE INDEX IF NOT EXISTS orders_due_date ON orders (order_due_date)",
+        "CREATE INDEX IF NOT EXISTS orders_user_due_date ON orders (user_id, order_due_date)",
+        "CREATE INDEX IF NOT EXISTS orders_status_due_date ON orders (status, order_due_date)",
+        # Covering indexes, the reference pages never need to visit the tables themselves
+        "CREATE INDEX IF NOT EXISTS color_palette_order ON color_palette (order_id, color_hex)",
+        "CREATE INDEX IF NOT EXISTS character_references_order ON character_references (order_id, file_path)",
+        "CREATE INDEX IF NOT EXISTS background_references_order ON background_references (order_id, file_path)",
+    ]),
+    (2, "Index reference paths, uploads are content-addressed and may be shared by several orders", [
+        "CREATE INDEX IF NOT EXISTS character_references_path ON character_references (file_path)",
+        "CREATE INDEX IF NOT EXISTS background_references_path ON background_references (file_path)",
+    ]),
+    (3, "Count orders and revenue by status and due week, kept up to date by triggers", [
+        """
+        CREATE TABLE IF NOT EXISTS order_counters (
+            status VARCHAR(10) NOT NULL,
+            due_week DATE NOT NULL, -- Monday of the week the order is due
+            orders INTEGER NOT NULL DEFAULT 0,
+            revenue NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (status, due_week)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS order_counters_insert AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO order_counters (status, due_week, orders, revenue)
+            VALUES (NEW.status, date(NEW.order_due_date, 'weekday 0', '-6 days'), 1, COALESCE(NEW.price, 0))
+            ON CONFLICT (status, due_week) DO UPDATE
+            SET orders = orders + 1, revenue = revenue + excluded.revenue;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS order_counters_delete AFTER DELETE ON orders
+        BEGIN
+            UPDATE order_counters
+            SET orders = orders - 1, revenue = revenue - COALESCE(OLD.price, 0)
+            WHERE status = OLD.status AND due_week = date(OLD.order_due_date, 'weekday 0', '-6 days');
+            DELETE FROM order_counters
+            WHERE status = OLD.status AND due_week = date(OLD.order_due_date, 'weekday 0', '-6 days') AND orders <= 0;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS order_counters_update AFTER UPDATE OF status, price, order_due_date ON orders
+        BEGIN
+            UPDATE order_counters
+            SET orders = orders - 1, revenue = revenue - COALESCE(OLD.price, 0)
+            WHERE status = OLD.status AND due_week = date(OLD.order_due_date, 'weekday 0', '-6 days');
+            INSERT INTO order_counters (status, due_week, orders, revenue)
+            VALUES (NEW.status, date(NEW.order_due_date, 'weekday 0', '-6 days'), 1, COALESCE(NEW.price, 0))
+            ON CONFLICT (status, due_week) DO UPDATE
+            SET orders = orders + 1, revenue = revenue + excluded.revenue;
+            DELETE FROM order_counters
+            WHERE status = OLD.status AND due_week = date(OLD.order_due_date, 'weekday 0', '-6 days') AND orders <= 0;
+        END
+        """,
+        # Start from the orders that already exist
+        "DELETE FROM order_counters",
+        """
+        INSERT INTO order_counters (status, due_week, orders, revenue)
+        SELECT status, date(order_due_date, 'weekday 0', '-6 days'), COUNT(*), SUM(COALESCE(price, 0))
+        FROM orders
+        GROUP BY 1, 2
+        """,
+    ]),
+    (4, "Full-text search over the descriptions of the orders", [
+        # The text stays in orders, the FTS table only stores the index
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS orders_fts USING fts5(
+            order_name, pose_description, character_features_description, outfit_description, background_description,
+            content = 'orders',
+            content_rowid = 'order_id',
+            tokenize = 'porter unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS orders_fts_insert AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO orders_fts (rowid, order_name, pose_description, character_features_description, outfit_description, background_description)
+            VALUES (NEW.order_id, NEW.order_name, NEW.pose_description, NEW.character_features_description, NEW.outfit_description, NEW.background_description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS orders_fts_delete AFTER DELETE ON orders
+        BEGIN
+            INSERT INTO orders_fts (orders_fts, rowid, order_name, pose_description, character_features_description, outfit_description, background_description)
+            VALUES ('delete', OLD.order_id, OLD.order_name, OLD.pose_description, OLD.character_features_description, OLD.outfit_description, OLD.background_description);
+        END
+        """,
+        # Status and price changes do not touch the index
+        """
+        CREATE TRIGGER IF NOT EXISTS orders_fts_update
+        AFTER UPDATE OF order_name, pose_description, character_features_description, outfit_description, background_description ON orders
+        BEGIN
+            INSERT INTO orders_fts (orders_fts, rowid, order_name, pose_description, character_features_description, outfit_description, background_description)
+            VALUES ('delete', OLD.order_id, OLD.order_name, OLD.pose_description, OLD.character_features_description, OLD.outfit_description, OLD.background_description);
+            INSERT INTO orders_fts (rowid, order_name, pose_description, character_features_description, outfit_description, background_description)
+            VALUES (NEW.order_id, NEW.order_name, NEW.pose_description, NEW.character_features_description, NEW.outfit_description, NEW.background_description);
+        END
+        """,
+        # Index the orders that already exist
+        "INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')",
+    ]),
+    (5, "Server side sessions shared by every worker", [
+        """
+        CREATE TABLE IF NOT EXISTS sessions (
+            session_id TEXT PRIMARY KEY,
+            value BLOB NOT NULL,
+            expires_at REAL NOT NULL
+        ) WITHOUT ROWID
+        """,
+        # Expired sessions are deleted in bulk by expiry
+        "CREATE INDEX IF NOT EXISTS sessions_expires_at ON sessions (expires_at)",
+    ]),
+    (6, "Order versions and display fields for the cached table rows", [
+        "ALTER TABLE orders ADD COLUMN version INTEGER NOT NULL DEFAULT 1",
+        "ALTER TABLE orders ADD COLUMN price_display TEXT NOT NULL DEFAULT '-'",
+        "ALTER TABLE orders ADD COLUMN status_label TEXT",
+        "ALTER TABLE orders ADD COLUMN status_class TEXT",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS orders_display_insert AFTER INSERT ON orders
+        BEGIN
+            UPDATE orders SET {DISPLAY_FIELDS} WHERE order_id = NEW.order_id;
+        END
+        """,
+        # Every write gives the order a new version, so its cached rows are rendered again.
+        # Triggers do not fire themselves, the update below does not start over.
+        f"""
+        CREATE TRIGGER IF NOT EXISTS orders_display_update AFTER UPDATE ON orders
+        BEGIN
+            UPDATE orders SET version = OLD.version + 1, {DISPLAY_FIELDS} WHERE order_id = NEW.order_id;
+        END
+        """,
+        f"UPDATE orders SET {DISPLAY_FIELDS}",
+    ]),
+    (7, "When each order was last written, for Last-Modified", [
+        "ALTER TABLE orders ADD COLUMN updated_at DATETIME",
+        "DROP TRIGGER IF EXISTS orders_display_insert",
+        "DROP TRIGGER IF EXISTS orders_display_update",
+        # Existing orders were last written when they were created, as far as anyone knows
+        "UPDATE orders SET updated_at = created_at",
+        f"""
+        CREATE TRIGGER orders_display_insert AFTER INSERT ON orders
+        BEGIN
+            UPDATE orders SET updated_at = CURRENT_TIMESTAMP, {DISPLAY_FIELDS} WHERE order_id = NEW.order_id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER orders_display_update AFTER UPDATE ON orders
+        BEGIN
+            UPDATE orders SET version = OLD.version + 1, updated_at = CURRENT_TIMESTAMP, {DISPLAY_FIELDS}
+            WHERE order_id = NEW.order_id;
+        END
+        """,
+    ]),
+    (8, "Append-only log of the status changes of every order", [
+        # No foreign key, the events of an order outlive it
+        """
+        CREATE TABLE IF NOT EXISTS order_events (
+            event_id INTEGER PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            ts TEXT NOT NULL DEFAULT (strftime('%Y-%m-%d %H:%M:%f', 'now')),
+            event TEXT NOT NULL,
+            from_status TEXT,
+            to_status TEXT,
+            user_id INTEGER,
+            price NUMERIC
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS order_events_order_ts ON order_events (order_id, ts)",
+        """
+        CREATE TRIGGER IF NOT EXISTS order_events_no_update BEFORE UPDATE ON order_events
+        BEGIN
+            SELECT RAISE(ABORT, 'order events are append-only');
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS order_events_no_delete BEFORE DELETE ON order_events
+        BEGIN
+            SELECT RAISE(ABORT, 'order events are append-only');
+        END
+        """,
+        # Replay the steps that led existing orders to their status, who priced them
+        # and when each step happened is not known
+        """
+        INSERT INTO order_events (order_id, ts, event, from_status, to_status, user_id)
+        SELECT order_id, created_at, 'place', NULL, 'pending', user_id FROM orders
+        """,
+        """
+        INSERT INTO order_events (order_id, ts, event, from_status, to_status, price)
+        SELECT order_id, updated_at, 'price', 'pending', 'reviewed', price FROM orders
+        WHERE status IN ('reviewed', 'accepted', 'completed')
+        """,
+        """
+        INSERT INTO order_events (order_id, ts, event, from_status, to_status, user_id)
+        SELECT order_id, updated_at, 'accept', 'reviewed', 'accepted', user_id FROM orders
+        WHERE status IN ('accepted', 'completed')
+        """,
+        """
+        INSERT INTO order_events (order_id, ts, event, from_status, to_status)
+        SELECT order_id, updated_at, 'complete', 'accepted', 'completed' FROM orders
+        WHERE status = 'completed'
+        """,
+    ]),
+    (9, "Whether the file of each reference has been stored yet, uploads are stored in the background", [
+        # Existing references were stored while their order was submitted
+        f"ALTER TABLE {table} ADD COLUMN status TEXT NOT NULL DEFAULT 'ready' CHECK (status IN ('pending', 'ready', 'failed'))"
+        for table in ("character_references", "background_references")
+    ] + [
+        # Keep the indexes by order covering now that the pages show the status too
+        statement
+        for table in ("character_references", "background_references")
+        for statement in (
+            f"DROP INDEX IF EXISTS {table}_order",
+            f"CREATE INDEX IF NOT EXISTS {table}_order ON {table} (order_id, file_path, status)",
+            # Writing the order gives it a new version, so its pages are not answered from caches
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {table}_status AFTER UPDATE OF status ON {table}
+            BEGIN
+                UPDATE orders SET updated_at = CURRENT_TIMESTAMP WHERE order_id = NEW.order_id;
+            END
+            """,
+        )
+    ]),
+    (10, "Outbox of due date reminders and overdue notices queued by the scheduler", [
+        # No foreign key, a notice about an order outlives it like its events do.
+        # An order gets each kind of notice once per due date, so moving the date gets it new ones.
+        """
+        CREATE TABLE IF NOT EXISTS order_reminders (
+            reminder_id INTEGER PRIMARY KEY,
+            order_id INTEGER NOT NULL,
+            kind TEXT NOT NULL CHECK (kind IN ('reminder', 'overdue')),
+            due_date DATE NOT NULL,
+            queued_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            delivered_at TEXT,
+            UNIQUE (order_id, kind, due_date)
+        )
+        """,
+        # Consumers read the notices not delivered yet, oldest first
+        "CREATE INDEX IF NOT EXISTS order_reminders_undelivered ON order_reminders (reminder_id) WHERE delivered_at IS NULL",
+    ]),
+]
+
+
+def schema_version(db):
+    """ Returns the version of the schema of the database """
+    return db.execute("SELECT user_version FROM pragma_user_version")[0]["user_version"]
+
+
+def run_migrations(db):
+    """ Applies every migration the database has not seen yet, returns the applied versions """
+    applied = []
+    if schema_version(db) >= MIGRATIONS[-1][0]:
+        return applied
+
+    # Workers starting together queue on the write lock, and the version is read again once it is held,
+    # so only the first of them migrates. The pending migrations are applied completely or not at all.
+    with db.transaction():
+        current = schema_version(db)
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            for statement in statements:
+                db.execute(statement)
+            db.execute(f"PRAGMA user_version = {int(version)}")
+            applied.append(version)
+
+    return applied
+
+
+def route_queries():
+    """ Returns (name, query, arguments) for every query the routes run with a WHERE or ORDER BY """
+    queries = [
+        ("order ownership", "SELECT order_id FROM orders WHERE order_id = ? AND user_id = ?", [1, 1]),
+        ("order", "SELECT * FROM orders WHERE order_id = ?", [1]),
+        ("order details", ORDER_DETAILS_QUERY, [1]),
+        ("owned order details", ORDER_DETAILS_QUERY + " AND orders.user_id = ?", [1, 1]),
+        ("order colors", "SELECT DISTINCT color_hex FROM color_palette WHERE order_id = ?", [1]),
+        ("character references", "SELECT file_path FROM character_references WHERE order_id = ?", [1]),
+        ("background references", "SELECT file_path FROM background_references WHERE order_id = ?", [1]),
+        ("order owner", "SELECT username, email FROM users WHERE id = ?", [1]),
+        ("role", "SELECT is_admin FROM users WHERE id = ?", [1]),
+        ("login", "SELECT * FROM users WHERE username = ?", ["admin"]),
+        ("referenced character files", "SELECT file_path FROM character_references WHERE file_path IN (?, ?)", ["a", "b"]),
+        ("referenced background files", "SELECT file_path FROM background_references WHERE file_path IN (?, ?)", ["a", "b"]),
+        ("email taken", "SELECT 1 FROM users WHERE email = ?", ["a@example.com"]),
+        ("stored character files", "UPDATE character_references SET status = ? WHERE file_path = ? AND status = 'pending'",
+         ["ready", "a"]),
+        ("stored background files", "UPDATE background_references SET status = ? WHERE file_path = ? AND status = 'pending'",
+         ["ready", "a"]),
+        ("order history", "SELECT order_events.*, users.username FROM order_events LEFT JOIN users ON users.id = order_events.user_id"
+                          " WHERE order_events.order_id = ? ORDER BY order_events.ts, order_events.event_id", [1]),
+        ("session", "SELECT value FROM sessions WHERE session_id = ? AND expires_at > ?", ["session:a", 0]),
+        ("search", SEARCH_QUERY + " ORDER BY rank LIMIT ? OFFSET ?", ['"pose"*', 26, 0]),
+        ("owned search", SEARCH_QUERY + " AND orders.user_id = ? ORDER BY rank LIMIT ? OFFSET ?", ['"pose"*', 1, 26, 0]),
+        ("upcoming deadlines", WINDOW_QUERY, ["pending", "2000-01-01", 1, "2000-01-10", 1000]),
+        ("written orders", EVENTS_QUERY, [1, 1000]),
+        ("undelivered reminders", UNDELIVERED_QUERY, [1000]),
+        ("live row", ROW_QUERY, [1]),
+    ]
+
+    # Every combination of listing filters, on the first page and on a later one
+    after = ("2000-01-01", 1)
+    for user_id in (None, 1):
+        for status in (None, STATUSES[0]):
+            for due_from, due_to in ((None, None), ("2000-01-01", None), (None, "2000-01-01")):
+                for cursor in (None, after):
+                    query, arguments = listing_query(user_id, status, due_from, due_to, cursor)
+                    name = f"listing user={user_id} status={status} from={due_from} to={due_to} after={cursor}"
+                    queries.append((name, query, arguments))
+
+    return queries
+
+
+def check_query_plans(db):
+    """ Returns (name, plan step) for every route query that scans a table or sorts its results """
+    failures = []
+
+    for name, query, arguments in route_queries():
+        for step in db.execute(f"EXPLAIN QUERY PLAN {query}", *arguments):
+            detail = step["detail"]
+
+            # Walking an index in order is fine, reading every row of the table or sorting them is not
+            if detail.startswith("SCAN") and "INDEX" not in detail:
+                failures.append((name, detail))
+            elif "TEMP B-TREE" in detail:
+                failures.append((name, detail))
+
+    return failures
@@ -0,0 +1,221 @@
+from database import db
+from fragments import forget_order
+from ingest import worker as ingest_worker
+from live import broker
+from reaper import reaper
+
+
+def insert_order_details(order_id, colors, character_references, background_references):
+    """
+    Adds the color palette and references of an order, one batched insert per table.
+
+    The references are dicts of path -> the temporary file just received for it (see process_files),
+    or None for a file that is already stored. Received files are stored once the order is committed,
+    their references are pending until then.
+    """
+    db.executemany("INSERT INTO color_palette (order_id, color_hex) VALUES (?, ?)",
+                   [(order_id, color) for color in colors])
+
+    for table, references in (("character_references", character_references),
+                              ("background_references", background_references)):
+        db.executemany(f"INSERT INTO {table} (order_id, file_path, status) VALUES (?, ?, ?)",
+                       [(order_id, path, "ready" if source is None else "pending")
+                        for path, source in references.items()])
+        db.on_commit(lambda table=table, references=references: ingest_worker.enqueue(table, references))
+
+
+def create_order(user_id, form_data, character_references, background_references):
+    """ Saves a new order with its palette and references in one transaction, returns its order_id """
+    with db.transaction():
+        order_id = db.execute("""
+                              INSERT INTO orders (
+                              user_id,
+                              order_name,
+                              character_part,
+                              preferred_style,
+                              pose_view,
+                              pose_description,
+                              character_features_description,
+                              outfit_description,
+                              has_background,
+                              background_description,
+                              order_due_date
+                              ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);
+                              """, user_id,
+                              form_data["order_name"],
+                              form_data["character_part"],
+                              form_data["preferred_style"],
+                              form_data["pose_view"],
+                              form_data["pose_description"],
+                              form_data["character_features_description"],
+                              form_data["outfit_description"],
+                              form_data["has_background"],
+                              form_data["background_description"],
+                              form_data["due_date"])
+
+        insert_order_details(order_id, form_data["colors"], character_references, background_references)
+        record_event(order_id, "place", None, "pending", user_id)
+
+    return order_id
+
+
+def update_order(order_id, user_id, form_data, character_references, background_references):
+    """
+    Saves the edited details of an order in one transaction, new references are added to the old ones.
+
+    Raises like transition() if the order can no longer be edited.
+    """
+    with db.transaction():
+        transition(order_id, "edit", user_id, False)
+
+        db.execute("""
+                   UPDATE orders
+                   SET
+                   order_name = ?,
+                   character_part = ?,
+                   preferred_style = ?,
+                   pose_view = ?,
+                   pose_description = ?,
+                   character_features_description = ?,
+                   outfit_description = ?,
+                   has_background = ?,
+                   background_description = ?,
+                   order_due_date = ?
+                   WHERE order_id = ?;
+                   """, form_data["order_name"],
+                   form_data["character_part"],
+                   form_data["preferred_style"],
+                   form_data["pose_view"],
+                   form_data["pose_description"],
+                   form_data["character_features_description"],
+                   form_data["outfit_description"],
+                   form_data["has_background"],
+                   form_data["background_description"],
+                   form_data["due_date"],
+                   order_id)
+
+        # The edit form submits the whole palette, so it replaces the old one
+        db.execute("DELETE FROM color_palette WHERE order_id = ?", order_id)
+
+        # An order without a background no longer needs its background references
+        removed = []
+        if form_data["has_background"] == 'FALSE':
+            removed = db.execute("SELECT file_path FROM background_references WHERE order_id = ?", order_id)
+            db.execute("DELETE FROM background_references WHERE order_id = ?", order_id)
+
+        insert_order_details(order_id, form_data["colors"], character_references, background_references)
+
+        # The files are deleted in the background, if no other order shares them
+        db.on_commit(lambda: reaper.enqueue([row["file_path"] for row in removed]))
+
+
+def delete_order(order_id):
+    """ Deletes an order, its palette and references, the files are deleted in the background """
+    with db.transaction():
+        removed = db.execute("""
+                             SELECT file_path FROM character_references WHERE order_id = ?
+                             UNION ALL
+                             SELECT file_path FROM background_references WHERE order_id = ?
+                             """, order_id, order_id)
+        db.execute("DELETE FROM orders WHERE order_id = ?", order_id)
+
+        db.on_commit(lambda: forget_order(int(order_id)))
+        db.on_commit(lambda: reaper.enqueue([row["file_path"] for row in removed]))
+
+
+# The lifecycle of an order: for each event and who applies it, the statuses it can happen in
+# and the status it leads to. None leads nowhere, the order is deleted.
+# Admins may remove an order at any point, its owner only before it is priced or once it is done.
+TRANSITIONS = {
+    ("edit", "owner"): (("pending",), "pending"),
+    ("price", "admin"): (("pending", "reviewed"), "reviewed"),
+    ("accept", "owner"): (("reviewed",), "accepted"),
+    ("reject", "owner"): (("reviewed",), None),
+    ("complete", "admin"): (("accepted",), "completed"),
+    ("remove", "owner"): (("pending", "completed"), None),
+    ("remove", "admin"): (("pending", "reviewed", "accepted", "completed"), None),
+}
+
+# Events the order buttons and the API may trigger directly
+ACTIONS = ("accept", "reject", "complete", "remove")
+
+
+def record_event(order_id, event, from_status, to_status, user_id, price=None):
+    """ Appends an event to the log of an order """
+    db.execute("""
+               INSERT INTO order_events (order_id, event, from_status, to_status, user_id, price)
+               VALUES (?, ?, ?, ?, ?, ?)
+               """, order_id, event, from_status, to_status, user_id, price)
+
+
+def transition(order_id, event, user_id, is_admin, price=None):
+    """
+    Moves an order along its lifecycle, returns its new status or None if it was deleted.
+
+    The event is logged and orders.status updated in the same transaction, and published to the
+    open dashboards once it is committed.
+    Raises LookupError if the order does not exist or belongs to someone else, PermissionError
+    if the user may not apply the event and ValueError if the order is not in a status it applies to.
+    """
+    with db.transaction():
+        rows = db.execute("SELECT user_id, status FROM orders WHERE order_id = ?", order_id)
+        if not rows or (not is_admin and rows[0]["user_id"] != user_id):
+            raise LookupError(f"no such order: {order_id}")
+
+        role = "admin" if is_admin else "owner"
+        if (event, role) not in TRANSITIONS:
+            if any(known == event for known, _ in TRANSITIONS):
+                raise PermissionError(f"cannot {event} order {order_id}")
+            raise ValueError(f"unknown action: {event}")
+
+        statuses, status = TRANSITIONS[(event, role)]
+        if rows[0]["status"] not in statuses:
+            raise ValueError(f"cannot {event} order {order_id}, it is {rows[0]['status']}")
+
+        record_event(order_id, event, rows[0]["status"], status, user_id, price)
+
+        if status is None:
+            delete_order(order_id)
+        elif event == "price":
+            db.execute("UPDATE orders SET price = ?, status = ? WHERE order_id = ?", price, status, order_id)
+        elif status != rows[0]["status"]:
+            db.execute("UPDATE orders SET status = ? WHERE order_id = ?", status, order_id)
+
+        # Open dashboards of the owner and the admins update the order's row once the change is committed
+        owner = rows[0]["user_id"]
+        db.on_commit(lambda: broker.publish({"order_id": int(order_id), "status": status}, owner))
+
+    return status
+
+
+def apply_action(order_id, action, user_id, is_admin):
+    """ Accepts, rejects, completes or removes an order, returns its new status or None if it was deleted """
+    if action not in ACTIONS:
+        raise ValueError(f"unknown action: {action}")
+    return transition(order_id, action, user_id, is_admin)
+
+
+def apply_actions(actions, user_id, is_admin):
+    """
+    Applies many (order_id, action) pairs in one transaction, returns the new status of each order.
+
+    If any of them cannot be applied, none of them are, and the error of the first one is raised.
+    """
+    with db.transaction():
+        return [apply_action(order_id, action, user_id, is_admin) for order_id, action in actions]
+
+
+def set_price(order_id, price, user_id):
+    """ Sets the price of an order that has not been accepted yet, which marks it reviewed """
+    return transition(order_id, "price", user_id, True, price)
+
+
+def order_history(order_id):
+    """ Returns the events of an order, oldest first, with who triggered them """
+    return db.execute("""
+                      SELECT order_events.*, users.username
+                      FROM order_events
+                      LEFT JOIN users ON users.id = order_events.user_id
+                      WHERE order_events.order_id = ?
+                      ORDER BY order_events.ts, order_events.event_id
+                      """, order_id)
@@ -0,0 +1,87 @@
+import concurrent.futures
+import logging
+import threading
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Passwords are hashed in this many processes, so a burst of logins does not stall the request threads
+# and never uses more than this many cores. Like the thumbnail workers they are spawned, not forked.
+# A spawned worker imports the __main__ module again, so a script that logs in must keep its code under
+# `if __name__ == "__main__":`. Where the workers cannot start, passwords are hashed on the request thread.
+WORKERS = 2
+START_METHOD = "spawn"
+
+# Most hashes waiting or running at once, and how long a request waits for its turn, in seconds.
+# Past that the request is turned away instead of piling up behind the others.
+MAX_PENDING = 16
+QUEUE_TIMEOUT = 5
+
+logger = logging.getLogger(__name__)
+
+
+class Busy(Exception):
+    """ Raised when too many passwords are being hashed already """
+
+
+class PasswordHasher:
+    """ Hashes and checks passwords in a bounded pool of processes """
+
+    def __init__(self, workers=WORKERS, max_pending=MAX_PENDING, timeout=QUEUE_TIMEOUT):
+        self.workers = workers
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+        self._pool = None
+        # Set once the workers could not start, passwords are then hashed in this process
+        self.in_process = False
+
+    def _get_pool(self):
+        """ Returns the process pool, starting it when the first password is hashed, or None if it cannot start """
+        with self._lock:
+            if self._pool is None and not self.in_process:
+                # Like the thumbnails, multiprocessing and the process pool are only imported then
+                import multiprocessing
+
+                self._pool = concurrent.futures.ProcessPoolExecutor(
+                    self.workers, mp_context=multiprocessing.get_context(START_METHOD))
+            return self._pool
+
+    def _drop_pool(self, pool, in_process=False):
+        """ Forgets a broken pool, the next password starts a new one unless in_process is set """
+        with self._lock:
+            if self._pool is pool:
+                self._pool = None
+            if in_process and not self.in_process:
+                self.in_process = True
+                logger.warning("Password workers cannot start, hashing passwords in this process instead")
+        pool.shutdown(wait=False)
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise Busy("too many passwords are being checked")
+        try:
+            # A broken pool is replaced once. If the new one breaks as well its workers cannot start,
+            # e.g. in a script without a __main__ guard, and the password is hashed here instead
+            for retry in (False, True):
+                pool = self._get_pool()
+                if pool is None:
+                    break
+                try:
+                    return pool.submit(function, *args).result()
+                except concurrent.futures.BrokenExecutor:
+                    # BrokenProcessPool: a worker died, e.g. killed out of memory, the pool refuses all work after that
+                    self._drop_pool(pool, in_process=retry)
+            return function(*args)
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        """ Returns the hash of a new password """
+        return self._run(generate_password_hash, password)
+
+    def check(self, password_hash, password):
+        """ Returns whether password matches password_hash """
+        return self._run(check_password_hash, password_hash, password)
+
+
+hasher = PasswordHasher()
@@ -0,0 +1,226 @@
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+from flask import before_render_template, g, has_app_context, request, template_rendered
+
+# Number of recent requests kept for the stats page
+RING_SIZE = 500
+
+# How often the stack of a sampled request is captured, in seconds
+SAMPLE_INTERVAL = 0.005
+
+# Longest statement text kept for the slowest query of a request
+MAX_SQL_LENGTH = 300
+
+
+def record_time(kind, seconds):
+    """ Adds time spent on something (such as "upload") to the profile of the current request, if it is profiled """
+    if has_app_context():
+        profile = g.get("profile")
+        if profile is not None:
+            profile[kind] += seconds
+
+
+def percentile(values, fraction):
+    """ Returns the value below which the given fraction of the sorted values fall """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class StackSampler:
+    """ Captures the stack of one thread at a fixed interval, counting identical stacks """
+
+    def __init__(self, thread_id, interval=SAMPLE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = collections.Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the requests: how many queries each one ran and how long they took,
+    its slowest statement, and the time spent rendering templates and receiving uploads.
+
+    The recent requests are kept in a ring buffer for the stats page, totals per route for /metrics.
+    Requests to the routes being sampled also have their stacks written out in the folded format
+    flame graph tools read, one file per route.
+    """
+
+    def __init__(self, size=RING_SIZE):
+        self.enabled = False
+        self.requests = collections.deque(maxlen=size)
+        self.totals = collections.defaultdict(lambda: collections.defaultdict(float))
+        self.sample_routes = set()
+        self.sample_rate = 0.0
+        self.sample_folder = "profiles"
+        self._lock = threading.Lock()
+
+    def init_app(self, app, db, sample_routes=(), sample_rate=0.0, sample_folder="profiles"):
+        """ Starts profiling the requests of app and the statements run on db """
+        self.enabled = True
+        self.sample_routes = set(sample_routes)
+        self.sample_rate = sample_rate
+        self.sample_folder = sample_folder
+
+        app.before_request(self._start)
+        app.after_request(self._finish)
+        db.listeners.append(self._query)
+        before_render_template.connect(self._render_start, app)
+        template_rendered.connect(self._render_end, app)
+
+    def _start(self):
+        g.profile = collections.defaultdict(float, start=time.perf_counter(), slowest_sql="", renders=[])
+        if request.endpoint in self.sample_routes and random.random() < self.sample_rate:
+            g.sampler = StackSampler(threading.get_ident()).start()
+
+    def _query(self, sql, seconds):
+        if not has_app_context():
+            return
+        profile = g.get("profile")
+        if profile is None:
+            return
+        profile["queries"] += 1
+        profile["sql"] += seconds
+        if seconds > profile["slowest_seconds"]:
+            profile["slowest_seconds"] = seconds
+            profile["slowest_sql"] = " ".join(sql.split())[:MAX_SQL_LENGTH]
+
+    def _render_start(self, sender, template, context, **extra):
+        profile = g.get("profile")
+        if profile is not None:
+            profile["renders"].append(time.perf_counter())
+
+    def _render_end(self, sender, template, context, **extra):
+        profile = g.get("profile")
+        if profile is not None and profile["renders"]:
+            start = profile["renders"].pop()
+            # Templates rendered while another one renders are counted in the outer one
+            if not profile["renders"]:
+                profile["template"] += time.perf_counter() - start
+
+    def _finish(self, response):
+        profile = g.pop("profile", None)
+        if profile is None:
+            return response
+
+        entry = {
+            "ts": time.time(),
+            "method": request.method,
+            "path": request.path,
+            "endpoint": request.endpoint or "-",
+            "status": response.status_code,
+            "seconds": time.perf_counter() - profile["start"],
+            "queries": int(profile["queries"]),
+            "sql": profile["sql"],
+            "slowest_sql": profile["slowest_sql"],
+            "slowest_seconds": profile["slowest_seconds"],
+            "template": profile["template"],
+            "upload": profile["upload"],
+        }
+
+        with self._lock:
+            self.requests.append(entry)
+            totals = self.totals[(entry["endpoint"], entry["method"])]
+            totals["requests"] += 1
+            for key in ("seconds", "queries", "sql", "template", "upload"):
+                totals[key] += entry[key]
+
+        sampler = g.pop("sampler", None)
+        if sampler is not None:
+            self._write_stacks(entry["endpoint"], sampler.stop())
+
+        # The same numbers for the browser's developer tools
+        response.headers["Server-Timing"] = (
+            f'sql;dur={entry["sql"] * 1000:.1f};desc="{entry["queries"]} queries", '
+            f'template;dur={entry["template"] * 1000:.1f}, upload;dur={entry["upload"] * 1000:.1f}, '
+            f'total;dur={entry["seconds"] * 1000:.1f}')
+        return response
+
+    def _write_stacks(self, endpoint, stacks):
+        """ Appends sampled stacks to the folded stacks file of a route """
+        os.makedirs(self.sample_folder, exist_ok=True)
+        with self._lock, open(os.path.join(self.sample_folder, f"{endpoint}.folded"), "a") as file:
+            for stack, count in stacks.items():
+                file.write(f"{stack} {count}\n")
+
+    def summary(self):
+        """ Returns the recent requests, newest first, and statistics by route over them """
+        with self._lock:
+            recent = list(self.requests)
+
+        routes = collections.defaultdict(list)
+        for entry in recent:
+            routes[(entry["endpoint"], entry["method"])].append(entry)
+
+        stats = []
+        for (endpoint, method), entries in sorted(routes.items()):
+            seconds = sorted(entry["seconds"] for entry in entries)
+            slowest = max(entries, key=lambda entry: entry["slowest_seconds"])
+            stats.append({
+                "endpoint": endpoint,
+                "method": method,
+                "requests": len(entries),
+                "p50": percentile(seconds, 0.5),
+                "p95": percentile(seconds, 0.95),
+                "queries": sum(entry["queries"] for entry in entries) / len(entries),
+                "max_queries": max(entry["queries"] for entry in entries),
+                "sql": sum(entry["sql"] for entry in entries) / len(entries),
+                "template": sum(entry["template"] for entry in entries) / len(entries),
+                "upload": sum(entry["upload"] for entry in entries) / len(entries),
+                "slowest_sql": slowest["slowest_sql"],
+                "slowest_seconds": slowest["slowest_seconds"],
+            })
+
+        return {"routes": stats, "recent": recent[::-1]}
+
+    def prometheus(self):
+        """ Returns the totals by route in the Prometheus text format """
+        metrics = [
+            ("requests", "app_requests_total", "counter", "Requests handled"),
+            ("seconds", "app_request_seconds_total", "counter", "Time spent handling requests"),
+            ("queries", "app_sql_queries_total", "counter", "SQL statements run"),
+            ("sql", "app_sql_seconds_total", "counter", "Time spent running SQL statements"),
+            ("template", "app_template_seconds_total", "counter", "Time spent rendering templates"),
+            ("upload", "app_upload_seconds_total", "counter", "Time spent receiving and storing uploads"),
+        ]
+
+        with self._lock:
+            totals = {key: dict(values) for key, values in self.totals.items()}
+
+        lines = []
+        for key, name, kind, description in metrics:
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            for (endpoint, method), values in sorted(totals.items()):
+                lines.append(f'{name}{{endpoint="{endpoint}",method="{method}"}} {values.get(key, 0):g}')
+        return "\n".join(lines) + "\n"
+
+
+profiler = Profiler()
@@ -0,0 +1,70 @@
+import threading
+import time
+
+from cache import TTLCache
+
+# Attempts a client may make in a burst, and how many seconds it takes to earn one more.
+# Every login or registration attempt costs a token from its IP address, logins also one from the username,
+# so a burst of guesses at one account is capped even when it comes from many addresses.
+IP_BURST = 20
+IP_REFILL = 3
+USERNAME_BURST = 5
+USERNAME_REFILL = 30
+
+# Most clients remembered, the ones seen least recently are forgotten (with a full bucket) first
+MAX_CLIENTS = 100000
+
+
+class TokenBucket:
+    """
+    Token buckets by key, such as an IP address: each holds up to burst tokens and earns one every refill seconds.
+
+    A bucket is only remembered until it would be full again, a bucket that is not remembered is full.
+    """
+
+    def __init__(self, burst, refill, maxsize=MAX_CLIENTS):
+        self.burst = burst
+        self.refill = refill
+        self._buckets = TTLCache(maxsize=maxsize, ttl=burst * refill)
+
+    def tokens(self, key, now):
+        """ Returns the tokens of a bucket at now """
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + (now - updated) / self.refill)
+
+    def take(self, key, tokens, now):
+        self._buckets.set(key, (tokens - 1, now))
+
+    def wait(self, key, now):
+        """ Returns how many seconds until a bucket has a token """
+        return max(0, (1 - self.tokens(key, now)) * self.refill)
+
+
+class RateLimiter:
+    """ Takes a token from several buckets at once, or from none of them if one is empty """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def allow(self, *limits):
+        """
+        Takes a token from every (bucket, key) pair if they all have one.
+
+        Returns 0 if they did, or the seconds until they all will.
+        """
+        now = time.monotonic()
+        with self._lock:
+            available = [bucket.tokens(key, now) for bucket, key in limits]
+            if any(tokens < 1 for tokens in available):
+                return max(bucket.wait(key, now) for bucket, key in limits)
+            for (bucket, key), tokens in zip(limits, available):
+                bucket.take(key, tokens, now)
+            return 0
+
+
+limiter = RateLimiter()
+by_ip = TokenBucket(IP_BURST, IP_REFILL)
+by_username = TokenBucket(USERNAME_BURST, USERNAME_REFILL)
@@ -0,0 +1,203 @@
+import logging
+import os
+import queue
+import threading
+import time
+
+from database import db
+from thumbnails import THUMBNAIL_FOLDER, UPLOAD_ROOT, derivative_path
+from uploads import INCOMING_FOLDER
+
+# Folders of uploaded references, relative to the app like the paths stored in the database
+REFERENCE_FOLDERS = [os.path.join(UPLOAD_ROOT, "character_references"),
+                     os.path.join(UPLOAD_ROOT, "background_references")]
+
+# Deletions are grouped into batches of up to BATCH_SIZE files, waiting at most BATCH_DELAY seconds
+BATCH_SIZE = 100
+BATCH_DELAY = 1.0
+
+# How often the uploads are reconciled with the database, and how old an unreferenced file must be
+# before it is reclaimed, so files whose order is still being saved are left alone
+GC_INTERVAL = 60 * 60
+GC_GRACE_PERIOD = 60 * 60
+
+logger = logging.getLogger(__name__)
+
+
+def referenced_paths(paths=None):
+    """ Returns which of the given paths (or of all paths if None) a reference row points to """
+    if paths is None:
+        rows = db.execute("""
+                          SELECT file_path FROM character_references
+                          UNION
+                          SELECT file_path FROM background_references
+                          """)
+    else:
+        placeholders = ", ".join("?" * len(paths))
+        rows = db.execute(f"""
+                          SELECT file_path FROM character_references WHERE file_path IN ({placeholders})
+                          UNION
+                          SELECT file_path FROM background_references WHERE file_path IN ({placeholders})
+                          """, *paths, *paths)
+    return {row["file_path"] for row in rows}
+
+
+def is_upload(path):
+    """ Returns whether a path, once symlinks and .. are resolved, is inside the uploads folder """
+    root = os.path.realpath(UPLOAD_ROOT)
+    return os.path.commonpath([root, os.path.realpath(path)]) == root
+
+
+def remove_file(path):
+    """ Deletes a file, returns the number of bytes reclaimed """
+    try:
+        size = os.path.getsize(path)
+        os.remove(path)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+def remove_with_derivatives(path):
+    """ Deletes an uploaded image and its thumbnails, returns the number of bytes reclaimed """
+    return (remove_file(path)
+            + remove_file(derivative_path(path, "jpg"))
+            + remove_file(derivative_path(path, "webp")))
+
+
+def reap(requests):
+    """
+    Deletes the files of a batch of (path, requested_at) pairs that are no longer referenced.
+    Only files inside the uploads folder are ever deleted.
+
+    A file touched after its deletion was requested was uploaded again in the meantime, it is kept.
+    """
+    requested = {}
+    for path, requested_at in requests:
+        requested[path] = max(requested_at, requested.get(path, 0))
+
+    in_use = referenced_paths(list(requested))
+
+    reclaimed = 0
+    for path, requested_at in requested.items():
+        if path in in_use:
+            continue
+        if not is_upload(path):
+            # Reference paths come from the database, never delete anything outside the uploads for them
+            logger.warning("Refusing to delete %s, it is not an upload", path)
+            continue
+        try:
+            if os.path.getmtime(path) > requested_at:
+                continue
+        except FileNotFoundError:
+            pass
+        reclaimed += remove_with_derivatives(path)
+    return reclaimed
+
+
+def walk(folder):
+    """ Yields the path and stat of every file under folder """
+    try:
+        entries = list(os.scandir(folder))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from walk(entry.path)
+        elif entry.is_file(follow_symlinks=False):
+            yield entry.path, entry.stat()
+
+
+def collect_garbage(grace_period=GC_GRACE_PERIOD):
+    """
+    Reclaims uploads no reference row points to, thumbnails of deleted images
+    and abandoned partial uploads. Returns a report of what was reclaimed.
+    """
+    start = time.monotonic()
+    cutoff = time.time() - grace_period
+    report = {"scanned": 0, "files": 0, "bytes": 0}
+
+    in_use = referenced_paths()
+    thumbnails = {derivative_path(path, extension) for path in in_use for extension in ("jpg", "webp")}
+
+    candidates = [(path, stat) for folder in REFERENCE_FOLDERS for path, stat in walk(folder)]
+    candidates += [(path, stat) for path, stat in walk(THUMBNAIL_FOLDER) if path not in thumbnails]
+    candidates += list(walk(os.path.join(UPLOAD_ROOT, INCOMING_FOLDER)))
+
+    for path, stat in candidates:
+        report["scanned"] += 1
+        if path in in_use or stat.st_mtime > cutoff:
+            continue
+        report["bytes"] += remove_file(path)
+        report["files"] += 1
+
+    report["seconds"] = time.monotonic() - start
+    return report
+
+
+class Reaper:
+    """ Deletes the files of removed references in batches, and collects orphaned uploads periodically """
+
+    def __init__(self, batch_size=BATCH_SIZE, batch_delay=BATCH_DELAY, gc_interval=GC_INTERVAL):
+        self.batch_size = batch_size
+        self.batch_delay = batch_delay
+        self.gc_interval = gc_interval
+        self.requests = queue.Queue()
+        self.reclaimed = 0
+        self.last_report = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def enqueue(self, paths):
+        """ Requests the deletion of files, they are only deleted if no reference points to them anymore """
+        now = time.time()
+        for path in paths:
+            self.requests.put((path, now))
+        self.start()
+
+    def start(self):
+        """ Starts the background thread on first use """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="reaper", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        next_gc = time.monotonic() + self.gc_interval
+        while True:
+            batch = self._next_batch(timeout=max(0, next_gc - time.monotonic()))
+            try:
+                if batch:
+                    self.reclaimed += reap(batch)
+                if time.monotonic() >= next_gc:
+                    next_gc = time.monotonic() + self.gc_interval
+                    self.last_report = collect_garbage()
+                    logger.info("Reclaimed %(files)d orphaned uploads, %(bytes)d bytes, in %(seconds).2fs",
+                                self.last_report)
+            except Exception:
+                logger.exception("Could not delete uploads")
+            finally:
+                for _ in batch:
+                    self.requests.task_done()
+
+    def _next_batch(self, timeout):
+        """ Waits for a deletion request, then gathers more for up to batch_delay seconds """
+        try:
+            batch = [self.requests.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.batch_delay
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(self.requests.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def flush(self):
+        """ Blocks until every requested deletion was handled """
+        self.requests.join()
+
+
+reaper = Reaper()
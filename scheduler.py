@@ -0,0 +1,181 @@
+import heapq
+import json
+import time
+from datetime import date, timedelta
+
+from database import db
+
+# Orders that are still to be delivered, a completed order is never late
+OPEN_STATUSES = ("pending", "reviewed", "accepted")
+
+# An order gets a reminder this many days before its due date, and an overdue notice the day after it.
+# Deadlines up to LOOKAHEAD_DAYS past the reminders due today are kept in memory.
+REMIND_DAYS = 3
+LOOKAHEAD_DAYS = 7
+
+# Rows read at once from the index of open orders and from the log of order events
+BATCH_SIZE = 1000
+
+# Seconds between two ticks of the scheduler
+TICK_INTERVAL = 60
+
+# The next open orders of a status after where the last read stopped, walking the (status, order_due_date) index
+WINDOW_QUERY = """
+    SELECT order_id, order_due_date FROM orders
+    WHERE status = ? AND (order_due_date, order_id) > (?, ?) AND order_due_date <= ?
+    ORDER BY order_due_date, order_id
+    LIMIT ?
+    """
+
+# Orders written since the last event seen, every write to an order appends to its log
+EVENTS_QUERY = "SELECT event_id, order_id FROM order_events WHERE event_id > ? ORDER BY event_id LIMIT ?"
+
+UNDELIVERED_QUERY = """
+    SELECT reminder_id, order_id, kind, due_date, queued_at FROM order_reminders
+    WHERE delivered_at IS NULL
+    ORDER BY reminder_id
+    LIMIT ?
+    """
+
+
+class DeadlineScheduler:
+    """
+    Queues reminders and overdue notices of open orders into the order_reminders outbox.
+
+    Upcoming deadlines wait in a min-heap. Orders are loaded into it as their due dates come within reach,
+    by seeking on the (status, order_due_date) index from where the last tick stopped, and orders that
+    were written are read again from the order events. A tick never reads the whole orders table,
+    its cost follows the number of orders coming due and written, not the number of open orders.
+    """
+
+    def __init__(self, remind_days=REMIND_DAYS, lookahead_days=LOOKAHEAD_DAYS, batch_size=BATCH_SIZE):
+        self.remind_days = remind_days
+        self.lookahead_days = lookahead_days
+        self.batch_size = batch_size
+        # (fires on, order_id, kind, due date), an entry whose due date is no longer the order's is skipped
+        self.heap = []
+        # Due date of the orders in the heap
+        self.due = {}
+        # Last (order_due_date, order_id) loaded of each status
+        self.loaded = {status: ("", 0) for status in OPEN_STATUSES}
+        self.last_event = None
+        self.horizon = ""
+
+    def tick(self, today=None):
+        """ Catches up with the orders coming due and the writes since the last tick, queues what is due """
+        today = today or date.today()
+        self.horizon = (today + timedelta(days=self.remind_days + self.lookahead_days)).isoformat()
+        notices = []
+
+        # Writes that happen while the orders are loaded are read again on the next tick
+        if self.last_event is None:
+            self.last_event = db.execute("SELECT COALESCE(MAX(event_id), 0) AS event_id FROM order_events")[0]["event_id"]
+
+        changed = self._follow_events(today, notices)
+        loaded = self._load(today, notices)
+
+        while self.heap and self.heap[0][0] <= today:
+            fires_on, order_id, kind, due_date = heapq.heappop(self.heap)
+            if self.due.get(order_id) != due_date:
+                continue
+            if kind == "overdue":
+                del self.due[order_id]
+            elif today > date.fromisoformat(due_date):
+                # Already late, only the overdue notice is sent
+                continue
+            notices.append((order_id, kind, due_date))
+
+        queued = db.executemany("INSERT OR IGNORE INTO order_reminders (order_id, kind, due_date) VALUES (?, ?, ?)",
+                                notices) if notices else 0
+        return {"loaded": loaded, "changed": changed, "queued": queued, "waiting": len(self.due)}
+
+    def _track(self, order_id, due_date, today, notices):
+        """ Schedules the reminder and overdue notice of an open order, or queues them now if they are due """
+        if self.due.get(order_id) == due_date:
+            return
+
+        due = date.fromisoformat(due_date)
+        if today > due:
+            # Already late, only the overdue notice is sent
+            self.due.pop(order_id, None)
+            notices.append((order_id, "overdue", due_date))
+            return
+
+        self.due[order_id] = due_date
+        heapq.heappush(self.heap, (due - timedelta(days=self.remind_days), order_id, "reminder", due_date))
+        heapq.heappush(self.heap, (due + timedelta(days=1), order_id, "overdue", due_date))
+
+    def _load(self, today, notices):
+        """ Loads the open orders whose due date came within the horizon since the last tick """
+        loaded = 0
+        for status in OPEN_STATUSES:
+            while True:
+                rows = db.execute(WINDOW_QUERY, status, *self.loaded[status], self.horizon, self.batch_size)
+                for row in rows:
+                    self._track(row["order_id"], row["order_due_date"], today, notices)
+                loaded += len(rows)
+                if rows:
+                    self.loaded[status] = (rows[-1]["order_due_date"], rows[-1]["order_id"])
+                if len(rows) < self.batch_size:
+                    break
+        return loaded
+
+    def _follow_events(self, today, notices):
+        """ Reads the orders written since the last tick again, their due date or status may have changed """
+        changed = 0
+        while True:
+            events = db.execute(EVENTS_QUERY, self.last_event, self.batch_size)
+            if not events:
+                return changed
+            self.last_event = events[-1]["event_id"]
+
+            order_ids = list({event["order_id"] for event in events})
+            placeholders = ", ".join("?" * len(order_ids))
+            orders = {row["order_id"]: row for row in db.execute(
+                f"SELECT order_id, status, order_due_date FROM orders WHERE order_id IN ({placeholders})", *order_ids)}
+
+            for order_id in order_ids:
+                order = orders.get(order_id)
+                if order is None or order["status"] not in OPEN_STATUSES:
+                    # Deleted or completed, its pending deadlines are skipped
+                    self.due.pop(order_id, None)
+                elif order["order_due_date"] <= self.horizon:
+                    self._track(order_id, order["order_due_date"], today, notices)
+                else:
+                    # Moved past the horizon, it is loaded again once the horizon gets there
+                    self.due.pop(order_id, None)
+            changed += len(order_ids)
+
+
+def deliver(sink, limit=BATCH_SIZE):
+    """ Appends the notices not delivered yet to a file as JSON lines, marks them delivered, returns how many """
+    notices = db.execute(UNDELIVERED_QUERY, limit)
+    if not notices:
+        return 0
+
+    for notice in notices:
+        sink.write(json.dumps(notice) + "\n")
+    sink.flush()
+
+    db.executemany("UPDATE order_reminders SET delivered_at = CURRENT_TIMESTAMP WHERE reminder_id = ?",
+                   [(notice["reminder_id"],) for notice in notices])
+    return len(notices)
+
+
+def run(scheduler, interval=TICK_INTERVAL, sink=None, once=False, report=print):
+    """ Ticks the scheduler every interval seconds, delivering the queued notices to sink if there is one """
+    while True:
+        start = time.monotonic()
+        result = scheduler.tick()
+        if sink is not None:
+            while True:
+                delivered = deliver(sink)
+                result["delivered"] = result.get("delivered", 0) + delivered
+                if delivered == 0:
+                    break
+        result["seconds"] = time.monotonic() - start
+        report(result)
+
+        if once:
+            return
+        time.sleep(max(0, interval - result["seconds"]))
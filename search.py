@@ -0,0 +1,76 @@
+import re
+
+from markupsafe import Markup, escape
+
+from database import db
+from listing import MAX_PAGE_SIZE, PAGE_SIZE
+
+# Matches are marked with these characters in the snippets, they are turned into <mark> tags
+# once the rest of the text has been escaped, so the order descriptions cannot inject HTML
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+# Number of tokens around the matches shown in a snippet
+SNIPPET_TOKENS = 12
+
+SEARCH_QUERY = f"""
+    SELECT orders.order_id, orders.order_name, orders.order_due_date, orders.price_display,
+    orders.status_label, orders.status_class,
+    snippet(orders_fts, -1, '{MATCH_START}', '{MATCH_END}', '…', {SNIPPET_TOKENS}) AS snippet
+    FROM orders_fts
+    JOIN orders ON orders.order_id = orders_fts.rowid
+    WHERE orders_fts MATCH ?
+    """
+
+
+def match_expression(text):
+    """
+    Turns what was typed in the search box into an FTS5 query, returns None if there is nothing to search.
+
+    Every word must appear in the order, the last one may be the start of a word. The words are quoted
+    so characters FTS5 treats as syntax are searched for like any other.
+    """
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+
+def highlight(snippet):
+    """ Escapes a snippet and marks the matching words """
+    return Markup(str(escape(snippet)).replace(MATCH_START, "<mark>").replace(MATCH_END, "</mark>"))
+
+
+def search_orders(text, user_id=None, page=1, limit=PAGE_SIZE):
+    """
+    Returns the orders matching a search, best match first, and whether there is a next page.
+
+    Only the orders of user_id are searched when it is given.
+    """
+    expression = match_expression(text)
+    if not expression:
+        return [], False
+
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = SEARCH_QUERY
+    arguments = [expression]
+    if user_id is not None:
+        query += " AND orders.user_id = ?"
+        arguments.append(user_id)
+
+    # One more row than shown tells whether there is a next page
+    query += " ORDER BY rank LIMIT ? OFFSET ?"
+    arguments += [limit + 1, (page - 1) * limit]
+
+    results = db.execute(query, *arguments)
+    for result in results:
+        result["snippet"] = highlight(result["snippet"])
+
+    return results[:limit], len(results) > limit
+
+
+def rebuild_search_index():
+    """ Reindexes every order, returns how many there are """
+    with db.transaction():
+        db.execute("INSERT INTO orders_fts (orders_fts) VALUES ('rebuild')")
+        return db.execute("SELECT COUNT(*) AS orders FROM orders")[0]["orders"]
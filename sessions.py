@@ -0,0 +1,128 @@
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from flask_session.base import ServerSideSession, ServerSideSessionInterface
+
+from database import db
+
+# Unchanged sessions are only written again once they were stored this many seconds ago,
+# to push their expiry back, instead of on every request
+REFRESH_AFTER = 60 * 60
+
+# Expired sessions are deleted in bulk at most this often, by whichever worker saves a session next
+EXPIRE_INTERVAL = 10 * 60
+
+
+class SQLiteStore:
+    """
+    Sessions stored in the sessions table of the app's database, shared by every worker using it.
+
+    The methods are the subset of the Redis client the sessions need, so a Redis client
+    (or anything that behaves like one) can be used in its place.
+    """
+
+    def __init__(self, db):
+        self.db = db
+
+    def get(self, name):
+        """ Returns the value of a session, or None if it does not exist or has expired """
+        rows = self.db.execute("SELECT value FROM sessions WHERE session_id = ? AND expires_at > ?",
+                               name, time.time())
+        return rows[0]["value"] if rows else None
+
+    def set(self, name, value, ex):
+        """ Stores a session for ex seconds """
+        self.db.execute("""
+                        INSERT INTO sessions (session_id, value, expires_at) VALUES (?, ?, ?)
+                        ON CONFLICT (session_id) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+                        """, name, value, time.time() + ex)
+
+    def delete(self, name):
+        self.db.execute("DELETE FROM sessions WHERE session_id = ?", name)
+
+    def delete_expired(self):
+        """ Deletes every expired session in one statement, returns how many there were """
+        return self.db.execute("DELETE FROM sessions WHERE expires_at <= ?", time.time())
+
+
+class StoreSession(ServerSideSession):
+    pass
+
+
+class StoreSessionInterface(ServerSideSessionInterface):
+    """
+    Flask-Session's server side sessions, kept in a store with get(), set() and delete().
+
+    A session is only written when it changed, or every REFRESH_AFTER seconds to keep it alive.
+    Stores with a delete_expired() method are also swept for expired sessions every EXPIRE_INTERVAL seconds,
+    stores that expire keys themselves, like Redis, are not.
+    """
+
+    session_class = StoreSession
+    # Stops Flask-Session from registering its own cleanup, expiry is handled here
+    ttl = True
+
+    def __init__(self, app, store, refresh_after=REFRESH_AFTER, expire_interval=EXPIRE_INTERVAL, **options):
+        self.store = store
+        self.refresh_after = refresh_after
+        self.expire_interval = expire_interval
+        self._next_expiry = time.monotonic() + expire_interval
+        self._lock = threading.Lock()
+        super().__init__(app, **options)
+
+    def should_set_storage(self, app, session):
+        # dict.get() does not mark the session as accessed, which would add Vary: Cookie to the response
+        stored_at = dict.get(session, "_stored_at", 0)
+        return session.modified or time.time() - stored_at >= self.refresh_after
+
+    def _retrieve_session_data(self, store_id):
+        value = self.store.get(store_id)
+        return self.serializer.decode(value) if value else None
+
+    def _delete_session(self, store_id):
+        self.store.delete(store_id)
+
+    def _upsert_session(self, session_lifetime, session, store_id):
+        session["_stored_at"] = int(time.time())
+        self.store.set(store_id, self.serializer.encode(session), ex=int(session_lifetime.total_seconds()))
+        self._expire_sessions()
+
+    def _expire_sessions(self):
+        """ Deletes the expired sessions if it has not been done for expire_interval seconds """
+        if not hasattr(self.store, "delete_expired"):
+            return
+        with self._lock:
+            if time.monotonic() < self._next_expiry:
+                return
+            self._next_expiry = time.monotonic() + self.expire_interval
+        self.store.delete_expired()
+
+    def delete_expired_sessions(self):
+        """ Deletes the expired sessions now, returns how many there were """
+        if hasattr(self.store, "delete_expired"):
+            return self.store.delete_expired()
+        return 0
+
+
+def session_store(url=None):
+    """
+    Returns the session store for a URL: a redis:// URL uses that Redis server,
+    anything else stores the sessions in the app's database.
+    """
+    if url and urlsplit(url).scheme in ("redis", "rediss", "unix"):
+        # Only needed when the sessions are kept in Redis
+        import redis
+        return redis.Redis.from_url(url)
+    return SQLiteStore(db)
+
+
+def init_sessions(app):
+    """ Stores the sessions of the app in the store chosen with the SESSION_STORE_URL environment variable """
+    app.session_interface = StoreSessionInterface(
+        app,
+        session_store(os.environ.get("SESSION_STORE_URL")),
+        key_prefix=app.config.get("SESSION_KEY_PREFIX", "session:"),
+        permanent=app.config.get("SESSION_PERMANENT", True),
+    )
@@ -0,0 +1,54 @@
+from database import db
+from listing import STATUSES
+
+# The counters as they would be if they were recomputed from every order
+RECOUNT_QUERY = """
+    SELECT status, date(order_due_date, 'weekday 0', '-6 days') AS due_week, COUNT(*) AS orders,
+    SUM(COALESCE(price, 0)) AS revenue
+    FROM orders
+    GROUP BY 1, 2
+    """
+
+
+def order_summary():
+    """
+    Returns the number of orders and revenue by status, and by due week and status.
+
+    The numbers come from order_counters, which triggers keep up to date on every write to orders,
+    so the cost does not depend on how many orders there are.
+    """
+    counters = db.execute("SELECT status, due_week, orders, revenue FROM order_counters ORDER BY due_week")
+
+    totals = {status: {"orders": 0, "revenue": 0} for status in STATUSES}
+    weeks = {}
+    for counter in counters:
+        totals[counter["status"]]["orders"] += counter["orders"]
+        totals[counter["status"]]["revenue"] += counter["revenue"]
+
+        week = weeks.setdefault(counter["due_week"], {status: 0 for status in STATUSES} | {"revenue": 0})
+        week[counter["status"]] = counter["orders"]
+        week["revenue"] += counter["revenue"]
+
+    return {
+        "totals": totals,
+        "orders": sum(total["orders"] for total in totals.values()),
+        "revenue": sum(total["revenue"] for total in totals.values()),
+        "weeks": [{"due_week": due_week, **week} for due_week, week in weeks.items()],
+    }
+
+
+def rebuild_counters():
+    """ Recomputes the counters from the orders, returns the number of (status, week) counters that had drifted """
+    with db.transaction():
+        stored = {(row["status"], row["due_week"]): (row["orders"], row["revenue"])
+                  for row in db.execute("SELECT status, due_week, orders, revenue FROM order_counters")}
+        actual = {(row["status"], row["due_week"]): (row["orders"], row["revenue"])
+                  for row in db.execute(RECOUNT_QUERY)}
+
+        drifted = sum(1 for key in stored.keys() | actual.keys() if stored.get(key) != actual.get(key))
+
+        db.execute("DELETE FROM order_counters")
+        db.executemany("INSERT INTO order_counters (status, due_week, orders, revenue) VALUES (?, ?, ?, ?)",
+                       [(status, due_week, orders, revenue) for (status, due_week), (orders, revenue) in actual.items()])
+
+    return drifted
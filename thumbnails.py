@@ -0,0 +1,157 @@
+import concurrent.futures
+import importlib.util
+import os
+import queue
+import threading
+import time
+
+# Pillow is optional, without it the pages keep showing the original images.
+# Only the worker processes import it, so starting the app does not pay for it.
+HAS_PILLOW = importlib.util.find_spec("PIL") is not None
+
+# Uploaded images live under UPLOAD_ROOT, their derivatives mirror that layout under THUMBNAIL_FOLDER
+UPLOAD_ROOT = "static/uploads"
+THUMBNAIL_FOLDER = "static/uploads/thumbnails"
+
+# Bounding box of a thumbnail in pixels, twice the size it is shown at for high density screens
+THUMBNAIL_SIZE = (240, 240)
+JPEG_QUALITY = 80
+WEBP_QUALITY = 75
+MAKE_WEBP = True
+
+# Images are resized in this many processes, so the requests never wait for them.
+# They are spawned rather than forked, a fork of the app's threads could copy locks other threads hold.
+WORKERS = 2
+START_METHOD = "spawn"
+
+
+def derivative_path(path, extension):
+    """ Returns where the derivative of an uploaded image with the given extension is stored """
+    folder = os.path.relpath(os.path.dirname(path), UPLOAD_ROOT)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(THUMBNAIL_FOLDER, folder, f"{name}.{extension}")
+
+
+def make_derivatives(path, size=THUMBNAIL_SIZE, webp=MAKE_WEBP):
+    """ Writes a downscaled JPEG (and WebP) of an image, runs in a worker process """
+    targets = [("jpg", "JPEG", {"quality": JPEG_QUALITY, "optimize": True, "progressive": True})]
+    if webp:
+        targets.append(("webp", "WEBP", {"quality": WEBP_QUALITY, "method": 4}))
+
+    from PIL import Image
+
+    with Image.open(path) as image:
+        # Decode at a reduced scale where the format allows it, then resize properly
+        image.draft("RGB", size)
+        image.thumbnail(size)
+        if image.mode not in ("RGB", "L"):
+            # Flatten transparency onto white, JPEG has no alpha channel
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.convert("RGBA").getchannel("A"))
+            image = background
+
+        for extension, image_format, options in targets:
+            target = derivative_path(path, extension)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            # Write next to the target and rename, so a page never serves a half written thumbnail
+            partial = f"{target}.{os.getpid()}.part"
+            image.save(partial, image_format, **options)
+            os.replace(partial, target)
+
+    return path
+
+
+class ThumbnailWorker:
+    """ Queues uploaded images and resizes them in a pool of processes in the background """
+
+    def __init__(self, workers=WORKERS):
+        self.workers = workers
+        self.jobs = queue.Queue()
+        self.pending = set()
+        self.failed = set()
+        self._lock = threading.Lock()
+        self._pool = None
+        self._thread = None
+
+    def enqueue(self, paths):
+        """ Schedules derivatives for the images that do not have them yet """
+        if not HAS_PILLOW:
+            return
+
+        queued = False
+        for path in paths:
+            with self._lock:
+                if path in self.pending or path in self.failed or os.path.exists(derivative_path(path, "jpg")):
+                    continue
+                self.pending.add(path)
+            self.jobs.put(path)
+            queued = True
+
+        if queued:
+            self._start()
+
+    def _start(self):
+        """ Starts the dispatcher and the process pool on first use """
+        with self._lock:
+            if self._thread is None:
+                self._pool = self._new_pool()
+                self._thread = threading.Thread(target=self._dispatch, name="thumbnails", daemon=True)
+                self._thread.start()
+
+    def _new_pool(self):
+        """ Returns a pool of spawned worker processes """
+        # multiprocessing and the process pool are only imported when the first image is resized
+        import multiprocessing
+
+        return concurrent.futures.ProcessPoolExecutor(self.workers,
+                                                      mp_context=multiprocessing.get_context(START_METHOD))
+
+    def _submit(self, path):
+        """ Hands an image to the pool, replacing the pool first if a worker died and broke it """
+        try:
+            return self._pool.submit(make_derivatives, path)
+        except concurrent.futures.BrokenExecutor:
+            # BrokenProcessPool: a worker was killed, e.g. out of memory, and the pool refuses new work
+            self._pool.shutdown(wait=False)
+            self._pool = self._new_pool()
+            return self._pool.submit(make_derivatives, path)
+
+    def _dispatch(self):
+        """ Hands queued images to the process pool """
+        while True:
+            path = self.jobs.get()
+            try:
+                future = self._submit(path)
+            except Exception:
+                # The image keeps being shown as it was uploaded, and wait() no longer waits for it
+                with self._lock:
+                    self.pending.discard(path)
+                    self.failed.add(path)
+                continue
+            future.add_done_callback(lambda future, path=path: self._done(path, future))
+
+    def _done(self, path, future):
+        with self._lock:
+            self.pending.discard(path)
+            if future.exception() is not None:
+                # Unreadable images keep being shown as they were uploaded
+                self.failed.add(path)
+
+    def wait(self):
+        """ Blocks until every queued image has been processed """
+        while True:
+            with self._lock:
+                if not self.pending:
+                    return
+            time.sleep(0.05)
+
+
+worker = ThumbnailWorker()
+
+
+def thumbnail(path, extension="jpg"):
+    """ Returns the derivative of an uploaded image if it is ready, or the original until then """
+    derivative = derivative_path(path, extension)
+    if os.path.exists(derivative):
+        return derivative
+    return path if extension == "jpg" else None
@@ -0,0 +1,324 @@
+import csv
+import io
+import json
+import os
+import time
+from datetime import date
+
+from database import db
+from migrations import DISPLAY_FIELDS
+from thumbnails import UPLOAD_ROOT
+from validation import ORDER_SCHEMA, validate_order
+
+# Columns of an exported order, the form fields come first so an export can be imported again
+EXPORT_FIELDS = ("order_id", "username", "order_name", "character_part", "preferred_style", "pose_view",
+                 "pose_description", "character_features_description", "outfit_description", "background",
+                 "background_description", "due_date", "status", "price", "created_at", "colors",
+                 "character_references", "background_references")
+
+# Columns holding lists, separated by spaces in CSV (colors and content-addressed paths have none)
+LIST_FIELDS = ("colors", "character_references", "background_references")
+
+# Columns an import reads as text
+TEXT_FIELDS = tuple(field for field, _, _ in ORDER_SCHEMA) + ("background_description", "username")
+
+FORMATS = ("csv", "jsonl")
+
+# Orders with their owner, palette and reference paths, the lists aggregated into JSON arrays
+EXPORT_QUERY = """
+    SELECT orders.order_id,
+    users.username,
+    orders.order_name,
+    orders.character_part,
+    orders.preferred_style,
+    orders.pose_view,
+    orders.pose_description,
+    orders.character_features_description,
+    orders.outfit_description,
+    CASE orders.has_background WHEN 'TRUE' THEN 'with-background' ELSE 'without-background' END AS background,
+    orders.background_description,
+    orders.order_due_date AS due_date,
+    orders.status,
+    orders.price,
+    orders.created_at,
+    (SELECT json_group_array(DISTINCT color_hex)
+     FROM color_palette WHERE order_id = orders.order_id) AS colors,
+    (SELECT json_group_array(file_path)
+     FROM character_references WHERE order_id = orders.order_id) AS character_references,
+    (SELECT json_group_array(file_path)
+     FROM background_references WHERE order_id = orders.order_id) AS background_references
+    FROM orders
+    JOIN users ON users.id = orders.user_id
+    """
+
+# Rows written out at once, and orders inserted per batch of an import
+CHUNK_SIZE = 1000
+BATCH_SIZE = 5000
+
+# Folders the references of an imported order must be in, the reaper may delete them once it is removed
+REFERENCE_FOLDERS = {table: os.path.join(UPLOAD_ROOT, table) for table in ("character_references",
+                                                                           "background_references")}
+
+# Triggers that index, format and count every new order one row at a time. An import drops them
+# inside its transaction, does their work for each batch with one statement each, and creates them
+# again before it commits, so other connections never see the orders table without them.
+BULK_TRIGGERS = ("orders_fts_insert", "orders_display_insert", "orders_display_update", "order_counters_insert")
+
+# The work of those triggers for a range of new orders
+BULK_STATEMENTS = (
+    """
+    INSERT INTO orders_fts (rowid, order_name, pose_description, character_features_description, outfit_description,
+    background_description)
+    SELECT order_id, order_name, pose_description, character_features_description, outfit_description,
+    background_description
+    FROM orders WHERE order_id BETWEEN ? AND ?
+    """,
+    f"UPDATE orders SET updated_at = CURRENT_TIMESTAMP, {DISPLAY_FIELDS} WHERE order_id BETWEEN ? AND ?",
+    # WHERE true tells the parser the ON CONFLICT belongs to the upsert, not to a join
+    """
+    INSERT INTO order_counters (status, due_week, orders, revenue)
+    SELECT status, date(order_due_date, 'weekday 0', '-6 days'), COUNT(*), COALESCE(SUM(price), 0)
+    FROM orders WHERE order_id BETWEEN ? AND ? AND true
+    GROUP BY 1, 2
+    ON CONFLICT (status, due_week) DO UPDATE
+    SET orders = orders + excluded.orders, revenue = revenue + excluded.revenue
+    """,
+)
+
+
+def export_orders(file_format, status=None, chunk_size=CHUNK_SIZE):
+    """
+    Yields every order as CSV or JSON lines, a chunk of text at a time.
+
+    The rows are read from a cursor as they are written, so memory use does not grow with the number of orders.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+
+    query, arguments = EXPORT_QUERY, []
+    if status:
+        query += " WHERE orders.status = ?"
+        arguments.append(status)
+    query += " ORDER BY orders.order_id"
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if file_format == "csv":
+        writer.writerow(EXPORT_FIELDS)
+
+    count = 0
+    for order in db.iterate(query, *arguments, size=chunk_size):
+        for field in LIST_FIELDS:
+            order[field] = json.loads(order[field])
+
+        if file_format == "csv":
+            writer.writerow([" ".join(order[field]) if field in LIST_FIELDS else order[field]
+                             for field in EXPORT_FIELDS])
+        else:
+            buffer.write(json.dumps(order))
+            buffer.write("\n")
+
+        count += 1
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+def read_orders(file, file_format):
+    """ Yields (line number, row, error) for every order of a CSV or JSON lines file """
+    if file_format == "csv":
+        reader = csv.DictReader(file)
+        for row in reader:
+            for field in LIST_FIELDS:
+                row[field] = (row.get(field) or "").split()
+            yield reader.line_num, row, None
+        return
+
+    for number, line in enumerate(file, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            yield number, None, "not valid JSON"
+            continue
+        if not isinstance(row, dict):
+            yield number, None, "not a JSON object"
+            continue
+        yield number, row, check_types(row)
+
+
+def check_types(row):
+    """ Returns what is wrong with the types of a JSON order, or None, filling in missing lists """
+    for field in LIST_FIELDS:
+        items = row.get(field) or []
+        if type(items) is not list or any(type(item) is not str for item in items):
+            return f"{', '.join(LIST_FIELDS)} must be lists of strings"
+        row[field] = items
+    for field in TEXT_FIELDS:
+        value = row.get(field)
+        if value is not None and type(value) is not str:
+            return "order fields must be strings"
+    return None
+
+
+def check_references(row):
+    """ Returns what is wrong with the reference paths of an order, or None, normalizing them """
+    for field, folder in REFERENCE_FOLDERS.items():
+        paths = [os.path.normpath(path) for path in row[field]]
+        if any(os.path.isabs(path) or not path.startswith(folder + os.sep) for path in paths):
+            return f"{field} must be files under {folder}/"
+        row[field] = paths
+    return None
+
+
+def next_order_id():
+    """ Returns the ID the next order will get, call it inside the transaction that inserts it """
+    return db.execute("""
+                      SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'orders'), 0),
+                      COALESCE((SELECT MAX(order_id) FROM orders), 0)) + 1 AS order_id
+                      """)[0]["order_id"]
+
+
+def drop_bulk_triggers():
+    """ Drops the BULK_TRIGGERS, call it inside a transaction. Returns the SQL that creates them again """
+    triggers = db.execute(f"""
+                          SELECT name, sql FROM sqlite_master
+                          WHERE type = 'trigger' AND name IN ({", ".join("?" * len(BULK_TRIGGERS))})
+                          """, *BULK_TRIGGERS)
+    for trigger in triggers:
+        db.execute(f"DROP TRIGGER {trigger['name']}")
+    return [trigger["sql"] for trigger in triggers]
+
+
+def insert_orders(batch, stored=None):
+    """
+    Saves a batch of (user_id, form_data, character_references, background_references) as new pending orders,
+    with one batched insert per table. Returns their order IDs.
+
+    Call it inside the transaction of an import, with the BULK_TRIGGERS dropped, see drop_bulk_triggers().
+    Reference paths are kept as they are, a reference whose file is not there is marked failed.
+    stored remembers which paths were found across batches.
+    """
+    stored = {} if stored is None else stored
+
+    def status(path):
+        if path not in stored:
+            stored[path] = os.path.isfile(path)
+        return "ready" if stored[path] else "failed"
+
+    # The write lock is held, so no other order can take these IDs
+    first = next_order_id()
+    order_ids = range(first, first + len(batch))
+
+    db.executemany("""
+                   INSERT INTO orders (order_id, user_id, order_name, character_part, preferred_style, pose_view,
+                   pose_description, character_features_description, outfit_description, has_background,
+                   background_description, order_due_date)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   """, [(order_id, user_id, form_data["order_name"], form_data["character_part"],
+                          form_data["preferred_style"], form_data["pose_view"], form_data["pose_description"],
+                          form_data["character_features_description"], form_data["outfit_description"],
+                          form_data["has_background"], form_data["background_description"], form_data["due_date"])
+                         for order_id, (user_id, form_data, _, _) in zip(order_ids, batch)])
+
+    for statement in BULK_STATEMENTS:
+        db.execute(statement, order_ids[0], order_ids[-1])
+
+    db.executemany("INSERT INTO color_palette (order_id, color_hex) VALUES (?, ?)",
+                   [(order_id, color) for order_id, (_, form_data, _, _) in zip(order_ids, batch)
+                    for color in dict.fromkeys(form_data["colors"])])
+    for table, index in (("character_references", 2), ("background_references", 3)):
+        db.executemany(f"INSERT INTO {table} (order_id, file_path, status) VALUES (?, ?, ?)",
+                       [(order_id, path, status(path))
+                        for order_id, order in zip(order_ids, batch) for path in order[index]])
+
+    db.executemany("INSERT INTO order_events (order_id, event, to_status, user_id) VALUES (?, 'place', 'pending', ?)",
+                   [(order_id, user_id) for order_id, (user_id, _, _, _) in zip(order_ids, batch)])
+
+    return list(order_ids)
+
+
+def save_batch(batch, stored, report):
+    """
+    Inserts a batch of (line number, order) inside a savepoint. If the database refuses it, the orders
+    are inserted one at a time instead, and the ones it still refuses are reported as rejected.
+    """
+    db.execute("SAVEPOINT batch")
+    try:
+        report["imported"] += len(insert_orders([order for _, order in batch], stored))
+        db.execute("RELEASE batch")
+        return
+    except ValueError:
+        db.execute("ROLLBACK TO batch")
+        db.execute("RELEASE batch")
+
+    for number, order in batch:
+        db.execute("SAVEPOINT batch")
+        try:
+            report["imported"] += len(insert_orders([order], stored))
+        except ValueError as e:
+            db.execute("ROLLBACK TO batch")
+            report["rejected"].append((number, [str(e)]))
+        db.execute("RELEASE batch")
+
+
+def import_orders(file, file_format, owner=None, keep_due_dates=False, batch_size=BATCH_SIZE):
+    """
+    Imports the orders of a CSV or JSON lines file (such as an export) as new pending orders.
+
+    Every row is checked against the rules of the order form, and its references must be files under
+    the reference folders. The rows that pass are saved in batches of batch_size orders, all in one
+    transaction, so other writers wait until the import is done. Orders belong to the user named
+    in their username column, or to owner if given. With keep_due_dates, due dates in the past are accepted.
+
+    Returns a report with the number of imported orders and the errors of the rejected rows by line.
+    """
+    if file_format not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+
+    start = time.monotonic()
+    users = {row["username"]: row["id"] for row in db.execute("SELECT id, username FROM users")}
+    today = date.min if keep_due_dates else date.today()
+    report = {"imported": 0, "rejected": [], "seconds": 0}
+
+    with db.transaction():
+        triggers = drop_bulk_triggers()
+
+        batch = []
+        stored = {}
+        for number, row, error in read_orders(file, file_format):
+            if error:
+                report["rejected"].append((number, [error]))
+                continue
+
+            username = owner or row.get("username")
+            form_data, errors = validate_order(row, row["colors"], today)
+            if username not in users:
+                errors = errors + [f"no such user: {username}"]
+            error = check_references(row)
+            if error:
+                errors = errors + [error]
+            if errors:
+                report["rejected"].append((number, errors))
+                continue
+
+            batch.append((number, (users[username], form_data, row["character_references"],
+                                   row["background_references"] if form_data["has_background"] == 'TRUE' else [])))
+            if len(batch) >= batch_size:
+                save_batch(batch, stored, report)
+                batch = []
+
+        if batch:
+            save_batch(batch, stored, report)
+
+        for sql in triggers:
+            db.execute(sql)
+
+    report["rejected"].sort()
+    report["seconds"] = time.monotonic() - start
+    return report
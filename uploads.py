@@ -0,0 +1,123 @@
+import hashlib
+import os
+import tempfile
+import time
+
+from flask import Request, current_app
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from profiling import record_time
+
+# Uploads are read and written in chunks of this size, so memory use does not grow with the file
+CHUNK_SIZE = 64 * 1024
+
+# Largest reference image and largest order form (all of its references together) accepted
+MAX_FILE_SIZE = 10 * 1024 * 1024
+MAX_REQUEST_SIZE = 50 * 1024 * 1024
+
+# Files being received are written here first, on the same file system as the uploads
+INCOMING_FOLDER = ".incoming"
+
+
+class HashingFile:
+    """
+    A temporary file that hashes an upload while Werkzeug streams it in.
+
+    Writing more than max_size bytes aborts the request before the rest of the body is read.
+    The file is deleted when it is closed, unless receive_upload() kept it for persist_upload().
+    """
+
+    def __init__(self, directory, max_size=MAX_FILE_SIZE):
+        os.makedirs(directory, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=directory, delete=False)
+        self.path = self.file.name
+        self.max_size = max_size
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.kept = False
+
+    def write(self, chunk):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            # The parser drops the file without closing it, so delete it now
+            self.close()
+            raise RequestEntityTooLarge(f"reference images must be under {self.max_size // (1024 * 1024)} MB")
+        start = time.perf_counter()
+        self.sha256.update(chunk)
+        written = self.file.write(chunk)
+        record_time("upload", time.perf_counter() - start)
+        return written
+
+    def close(self):
+        self.file.close()
+        if not self.kept:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+    def __getattr__(self, name):
+        # read(), seek(), readline() and the rest come from the temporary file
+        return getattr(self.file, name)
+
+
+class UploadRequest(Request):
+    """ A request that streams uploaded files straight to disk, hashing them on the way """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return HashingFile(os.path.join(current_app.config["UPLOAD_FOLDER"], INCOMING_FOLDER),
+                           current_app.config.get("MAX_FILE_SIZE", MAX_FILE_SIZE))
+
+
+def content_path(upload_folder, digest, extension):
+    """ Returns where the file with the given SHA-256 digest is stored, sharded by the first two characters """
+    return os.path.join(upload_folder, digest[:2], f"{digest}.{extension}")
+
+
+def receive_upload(file, upload_folder, extension):
+    """
+    Returns the path an uploaded file will be stored at, under the digest of its content,
+    and the temporary file holding it until persist_upload() moves it there.
+
+    The temporary file outlives the request, so the file can be stored after the response was sent.
+    """
+    stream = file.stream
+
+    if not isinstance(stream, HashingFile):
+        # Copy any other stream to a temporary file in chunks, hashing it on the way
+        stream = HashingFile(os.path.join(os.path.dirname(upload_folder), INCOMING_FOLDER))
+        try:
+            for chunk in iter(lambda: file.stream.read(CHUNK_SIZE), b""):
+                stream.write(chunk)
+        except RequestEntityTooLarge:
+            stream.close()
+            raise
+
+    # Otherwise it is already on disk and was hashed while it was received
+    stream.file.flush()
+    stream.kept = True
+    stream.file.close()
+    return content_path(upload_folder, stream.sha256.hexdigest(), extension), stream.path
+
+
+def persist_upload(source, path):
+    """
+    Moves a received file from its temporary path to its content path and makes sure it is on disk.
+
+    Identical files are only stored once, a second upload of the same image reuses the first one.
+    """
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if os.path.exists(path):
+        # Deduplicated, the same image is already stored so the temporary file is deleted.
+        # Touch the stored file so a pending deletion of it knows it is in use again.
+        os.remove(source)
+        os.utime(path)
+    else:
+        with open(source, "rb") as file:
+            os.fsync(file.fileno())
+        os.replace(source, path)
+
+    record_time("upload", time.perf_counter() - start)
+    return path
@@ -0,0 +1,102 @@
+import re
+from datetime import date
+
+# The order form, declared once: (field, what it is called in errors, the values it may take or None for free text).
+# Every field is required, the background description only for orders with a background.
+ORDER_SCHEMA = (
+    ("order_name", "order name", None),
+    ("character_part", "character part", ("Head", "Half Body", "Full Body")),
+    ("preferred_style", "preferred style", ("Chibi", "Normal")),
+    ("pose_view", "pose view", ("Front View", "3/4 View", "Side View")),
+    ("pose_description", "pose description", None),
+    ("character_features_description", "character features description", None),
+    ("outfit_description", "outfit description", None),
+    ("background", "background preference", ("with-background", "without-background")),
+    ("due_date", "due date", None),
+)
+
+COLOR = re.compile(r"#[0-9A-Fa-f]{6}")
+DATE = re.compile(r"([0-9]{4})-([0-9]{1,2})-([0-9]{1,2})")
+
+# Fewest different colors in a palette
+MIN_COLORS = 2
+
+
+def compile_schema(schema):
+    """ Turns a schema into (field, message if missing, allowed values, message if not allowed) checks """
+    checks = []
+    for field, label, options in schema:
+        checks.append((field, f"must provide {label}", frozenset(options) if options else None, f"invalid {label}"))
+    return tuple(checks)
+
+
+ORDER_CHECKS = compile_schema(ORDER_SCHEMA)
+
+
+def is_valid_color(color):
+    """ Validate if the input is a valid hex color code. """
+    return isinstance(color, str) and COLOR.fullmatch(color) is not None
+
+
+def parse_date(value):
+    """ Returns the date of a YYYY-MM-DD string, or None if it is not one """
+    match = DATE.fullmatch(value)
+    if not match:
+        return None
+    try:
+        return date(int(match[1]), int(match[2]), int(match[3]))
+    except ValueError:
+        return None
+
+
+def validate_order(data, colors, today=None):
+    """
+    Validates the fields of an order in one pass, from the order form, the API or an import.
+
+    Returns the cleaned up order and no errors, or None and every reason it is invalid.
+    """
+    errors = []
+    values = {}
+
+    for field, missing, options, invalid in ORDER_CHECKS:
+        value = data.get(field)
+        if not value:
+            errors.append(missing)
+        elif options is not None and value not in options:
+            errors.append(invalid)
+        values[field] = value
+
+    has_background = values["background"] == "with-background"
+    background_description = data.get("background_description") if has_background else None
+    if has_background and not background_description:
+        errors.append("must provide background description")
+
+    if not all(is_valid_color(color) for color in colors):
+        errors.append("invalid color(s)")
+    elif len(set(colors)) < MIN_COLORS:
+        errors.append("must provide at least two different colors")
+
+    # The due date must be after today, it is stored as YYYY-MM-DD like SQLite's date functions expect
+    if values["due_date"]:
+        due_date = parse_date(values["due_date"])
+        if due_date is None:
+            errors.append("invalid due date")
+        elif due_date <= (today or date.today()):
+            errors.append("due date is in the past")
+
+    if errors:
+        return None, errors
+
+    return {
+        "order_name": values["order_name"],
+        "character_part": values["character_part"],
+        "preferred_style": values["preferred_style"],
+        "pose_view": values["pose_view"],
+        "pose_description": values["pose_description"],
+        "character_features_description": values["character_features_description"],
+        "outfit_description": values["outfit_description"],
+        "has_background": 'TRUE' if has_background else 'FALSE',
+        "background_description": background_description,
+        "due_date": due_date.isoformat(),
+        "colors": colors,
+    }, []